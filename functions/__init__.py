@@ -1 +1 @@
-from functions.functions import seed_all
\ No newline at end of file
+from functions.functions import seed_all, MetricAccumulator, compute_loss
\ No newline at end of file
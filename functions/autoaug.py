@@ -2,6 +2,7 @@ from PIL import Image, ImageEnhance, ImageOps
 import numpy as np
 import random
 import torch
+import torch.nn.functional as F
 
 
 class Cutout(object):
@@ -45,6 +46,62 @@ class Cutout(object):
         return img
 
 
+class BatchCutout(object):
+    """Cutout on a whole batch, with hole centers for every sample drawn at once.
+    Args:
+        n_holes (int): Number of patches to cut out of each image.
+        length (int): The length (in pixels) of each square patch.
+    """
+
+    def __init__(self, n_holes, length):
+        self.n_holes = n_holes
+        self.length = length
+
+    def __call__(self, imgs):
+        """
+        Args:
+            imgs (Tensor): Tensor images of size (B, C, H, W).
+        Returns:
+            Tensor: Images with n_holes of dimension length x length cut out of each.
+        """
+        b, _, h, w = imgs.shape
+        y = torch.randint(h, (b, self.n_holes, 1, 1), device=imgs.device)
+        x = torch.randint(w, (b, self.n_holes, 1, 1), device=imgs.device)
+        rows = torch.arange(h, device=imgs.device).view(1, 1, h, 1)
+        cols = torch.arange(w, device=imgs.device).view(1, 1, 1, w)
+        # same half-open [c - length // 2, c + length // 2) extent as Cutout
+        inside = (rows >= y - self.length // 2) & (rows < y + self.length // 2) & \
+                 (cols >= x - self.length // 2) & (cols < x + self.length // 2)
+        return imgs.masked_fill(inside.any(1, keepdim=True), 0)
+
+
+class BatchRandomCropFlip(object):
+    """RandomCrop with zero padding followed by RandomHorizontalFlip, as one gather over the batch.
+    Args:
+        size (int): Output height and width.
+        padding (int): Zero padding added on every border before cropping.
+    """
+
+    def __init__(self, size, padding=4):
+        self.size = size
+        self.padding = padding
+
+    def __call__(self, imgs):
+        b, c, h, w = imgs.shape
+        p = self.padding
+        padded = F.pad(imgs, (p, p, p, p))
+        top = torch.randint(h + 2 * p - self.size + 1, (b, 1), device=imgs.device)
+        left = torch.randint(w + 2 * p - self.size + 1, (b, 1), device=imgs.device)
+        flip = torch.rand(b, 1, device=imgs.device) < 0.5
+        span = torch.arange(self.size, device=imgs.device).view(1, -1)
+        rows = top + span
+        cols = left + torch.where(flip, self.size - 1 - span, span)
+        batch = torch.arange(b, device=imgs.device).view(-1, 1, 1)
+        # advanced indexing puts the channel dimension last
+        return padded.permute(0, 2, 3, 1)[batch, rows.unsqueeze(2), cols.unsqueeze(1)] \
+            .permute(0, 3, 1, 2).contiguous()
+
+
 class ImageNetPolicy(object):
     """ Randomly choose one of the best 24 Sub-policies on ImageNet.
 
@@ -218,7 +275,7 @@ class SubPolicy(object):
             "translateY": np.linspace(0, 150 / 331, 10),
             "rotate": np.linspace(0, 30, 10),
             "color": np.linspace(0.0, 0.9, 10),
-            "posterize": np.round(np.linspace(8, 4, 10), 0).astype(np.int),
+            "posterize": np.round(np.linspace(8, 4, 10), 0).astype(int),
             "solarize": np.linspace(256, 0, 10),
             "contrast": np.linspace(0.0, 0.9, 10),
             "sharpness": np.linspace(0.0, 0.9, 10),
@@ -281,3 +338,178 @@ class SubPolicy(object):
         if random.random() < self.p2:
             img = self.operation2(img, self.magnitude2)
         return img
+
+
+class BatchCIFAR10Policy(object):
+    """ The 25 CIFAR10 Sub-policies applied to a whole uint8 batch at once.
+        Every sample draws its own sub-policy, application and sign; samples sharing an operation
+        are transformed together.
+
+        Example as a collate transform:
+        >>> policy = BatchCIFAR10Policy()
+        >>> images = policy(images)  # uint8 tensor of size (B, 3, H, W)
+    """
+
+    def __init__(self, fillcolor=128):
+        policies = [
+            (0.1, "invert", 7, 0.2, "contrast", 6),
+            (0.7, "rotate", 2, 0.3, "translateX", 9),
+            (0.8, "sharpness", 1, 0.9, "sharpness", 3),
+            (0.5, "shearY", 8, 0.7, "translateY", 9),
+            (0.5, "autocontrast", 8, 0.9, "equalize", 2),
+
+            (0.2, "shearY", 7, 0.3, "posterize", 7),
+            (0.4, "color", 3, 0.6, "brightness", 7),
+            (0.3, "sharpness", 9, 0.7, "brightness", 9),
+            (0.6, "equalize", 5, 0.5, "equalize", 1),
+            (0.6, "contrast", 7, 0.6, "sharpness", 5),
+
+            (0.7, "color", 7, 0.5, "translateX", 8),
+            (0.3, "equalize", 7, 0.4, "autocontrast", 8),
+            (0.4, "translateY", 3, 0.2, "sharpness", 6),
+            (0.9, "brightness", 6, 0.2, "color", 8),
+            (0.5, "solarize", 2, 0.0, "invert", 3),
+
+            (0.2, "equalize", 0, 0.6, "autocontrast", 0),
+            (0.2, "equalize", 8, 0.8, "equalize", 4),
+            (0.9, "color", 9, 0.6, "equalize", 6),
+            (0.8, "autocontrast", 4, 0.2, "solarize", 8),
+            (0.1, "brightness", 3, 0.7, "color", 0),
+
+            (0.4, "solarize", 5, 0.9, "autocontrast", 3),
+            (0.9, "translateY", 9, 0.7, "translateY", 9),
+            (0.9, "autocontrast", 2, 0.8, "solarize", 3),
+            (0.8, "equalize", 8, 0.1, "invert", 3),
+            (0.7, "translateY", 9, 0.9, "autocontrast", 1)
+        ]
+        ranges = {
+            "shearX": np.linspace(0, 0.3, 10),
+            "shearY": np.linspace(0, 0.3, 10),
+            "translateX": np.linspace(0, 150 / 331, 10),
+            "translateY": np.linspace(0, 150 / 331, 10),
+            "rotate": np.linspace(0, 30, 10),
+            "color": np.linspace(0.0, 0.9, 10),
+            "posterize": np.round(np.linspace(8, 4, 10), 0),
+            "solarize": np.linspace(256, 0, 10),
+            "contrast": np.linspace(0.0, 0.9, 10),
+            "sharpness": np.linspace(0.0, 0.9, 10),
+            "brightness": np.linspace(0.0, 0.9, 10),
+            "autocontrast": [0] * 10,
+            "equalize": [0] * 10,
+            "invert": [0] * 10
+        }
+        self.fillcolor = fillcolor
+        self.ops = list(ranges.keys())
+        self.func = {
+            "shearX": lambda img, m, s: self._affine(img, [1, m * s, 0, 0, 1, 0], 'bicubic'),
+            "shearY": lambda img, m, s: self._affine(img, [1, 0, 0, m * s, 1, 0], 'bicubic'),
+            "translateX": lambda img, m, s: self._affine(img, [1, 0, m * s * img.size(3), 0, 1, 0], 'nearest'),
+            "translateY": lambda img, m, s: self._affine(img, [1, 0, 0, 0, 1, m * s * img.size(2)], 'nearest'),
+            "rotate": lambda img, m, s: self._rotate(img, m),
+            "color": lambda img, m, s: _blend(_grayscale(img).expand_as(img), img, 1 + m * s),
+            "posterize": lambda img, m, s: _posterize(img, m),
+            "solarize": lambda img, m, s: torch.where(img < m.view(-1, 1, 1, 1), img, 255 - img),
+            "contrast": lambda img, m, s: _blend(
+                _grayscale(img).mean((1, 2, 3), keepdim=True).add(0.5).floor(), img, 1 + m * s),
+            "sharpness": lambda img, m, s: _blend(_smooth(img), img, 1 + m * s),
+            "brightness": lambda img, m, s: _blend(torch.zeros_like(img), img, 1 + m * s),
+            "autocontrast": lambda img, m, s: _autocontrast(img),
+            "equalize": lambda img, m, s: _equalize(img),
+            "invert": lambda img, m, s: 255 - img
+        }
+        self.p = torch.tensor([[p[0], p[3]] for p in policies])
+        self.op = torch.tensor([[self.ops.index(p[1]), self.ops.index(p[4])] for p in policies])
+        self.magnitude = torch.tensor([[float(ranges[p[1]][p[2]]), float(ranges[p[4]][p[5]])] for p in policies])
+
+    def __call__(self, imgs):
+        b = imgs.size(0)
+        idx = torch.randint(len(self.p), (b,))
+        applied = torch.rand(b, 2) < self.p[idx]
+        sign = torch.randint(0, 2, (b, 2)).float() * 2 - 1
+        op, magnitude = self.op[idx], self.magnitude[idx]
+        out = imgs.float()
+        for stage in range(2):
+            for i, name in enumerate(self.ops):
+                sel = (applied[:, stage] & (op[:, stage] == i)).nonzero().flatten()
+                if sel.numel() == 0:
+                    continue
+                m = magnitude[sel, stage].to(out.device)
+                s = sign[sel, stage].to(out.device)
+                out[sel] = self.func[name](out[sel], m, s).round().clamp(0, 255)
+        return out.to(imgs.dtype)
+
+    def _affine(self, img, coeffs, mode):
+        # coeffs follow PIL's AFFINE data: output pixel (x, y) samples input (a x + b y + c, d x + e y + f)
+        n, _, h, w = img.shape
+        matrix = torch.zeros(n, 3, 3, device=img.device)
+        for k, c in enumerate(coeffs):
+            matrix[:, k // 3, k % 3] = c
+        matrix[:, 2, 2] = 1
+        return self._sample(img, matrix, mode)
+
+    def _rotate(self, img, degrees):
+        # PIL rotates counter-clockwise around the image centre
+        n, _, h, w = img.shape
+        angle = -torch.deg2rad(degrees)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        cx, cy = w / 2, h / 2
+        matrix = torch.zeros(n, 3, 3, device=img.device)
+        matrix[:, 0, 0], matrix[:, 0, 1] = cos, sin
+        matrix[:, 1, 0], matrix[:, 1, 1] = -sin, cos
+        matrix[:, 0, 2] = cx - cos * cx - sin * cy
+        matrix[:, 1, 2] = cy + sin * cx - cos * cy
+        matrix[:, 2, 2] = 1
+        return self._sample(img, matrix, 'nearest')
+
+    def _sample(self, img, matrix, mode):
+        n, c, h, w = img.shape
+        # map pixel space to grid_sample's normalized [-1, 1] coordinates
+        norm = torch.tensor([[2 / w, 0, -1], [0, 2 / h, -1], [0, 0, 1]], device=img.device)
+        theta = (norm @ matrix @ torch.linalg.inv(norm))[:, :2]
+        grid = F.affine_grid(theta, (n, c, h, w), align_corners=False)
+        # zero padding around the shifted image becomes the fill color
+        out = F.grid_sample(img - self.fillcolor, grid, mode=mode, padding_mode='zeros', align_corners=False)
+        return out + self.fillcolor
+
+    def __repr__(self):
+        return "AutoAugment CIFAR10 Batch Policy"
+
+
+def _blend(degenerate, img, factor):
+    return degenerate + factor.view(-1, 1, 1, 1) * (img - degenerate)
+
+
+def _grayscale(img):
+    return (img[:, 0:1] * 299 + img[:, 1:2] * 587 + img[:, 2:3] * 114) / 1000
+
+
+def _smooth(img):
+    # PIL's SMOOTH filter, leaving the border pixels untouched like ImageEnhance.Sharpness
+    kernel = torch.tensor([[1., 1., 1.], [1., 5., 1.], [1., 1., 1.]], device=img.device) / 13
+    out = F.conv2d(img, kernel.expand(img.size(1), 1, 3, 3), groups=img.size(1)).round()
+    return F.pad(out, (1, 1, 1, 1)) + (img - F.pad(img[:, :, 1:-1, 1:-1], (1, 1, 1, 1)))
+
+
+def _posterize(img, bits):
+    shift = (8 - bits).long().view(-1, 1, 1, 1)
+    return ((img.long() >> shift) << shift).float()
+
+
+def _autocontrast(img):
+    lo = img.amin((2, 3), keepdim=True)
+    hi = img.amax((2, 3), keepdim=True)
+    scale = 255 / (hi - lo).clamp(min=1)
+    return torch.where(hi > lo, ((img - lo) * scale).floor(), img)
+
+
+def _equalize(img):
+    # per-channel version of ImageOps.equalize's histogram lookup table
+    n, c, h, w = img.shape
+    x = img.long().reshape(n * c, h * w)
+    offset = torch.arange(n * c, device=img.device).view(-1, 1) * 256
+    hist = torch.bincount((x + offset).flatten(), minlength=n * c * 256).view(n * c, 256)
+    last = hist.gather(1, x.amax(1, keepdim=True))
+    step = (h * w - last) // 255
+    lut = (step // 2 + hist.cumsum(1) - hist) // step.clamp(min=1)
+    out = lut.clamp(max=255).gather(1, x)
+    return torch.where(step > 0, out, x).view(n, c, h, w).float()
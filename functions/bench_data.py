@@ -0,0 +1,135 @@
+import argparse
+import itertools
+import json
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from functions.autoaug import CIFAR10Policy, BatchCIFAR10Policy, SubPolicy
+from functions.datasets import build_cifar, build_loader
+
+
+def timed(fn, repeats):
+    """Seconds per call of fn, after one warm-up call."""
+    fn()
+    s_time = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - s_time) / repeats
+
+
+def bench_transforms(dataset, n):
+    """Per-sample latency of every stage of the train transform chain, each fed the previous stage's outputs."""
+    samples = [Image.fromarray(img) for img in dataset.data[:n]]
+    results = []
+    for t in dataset.transform.transforms:
+        s_time = time.perf_counter()
+        samples = [t(img) for img in samples]
+        results.append({'name': type(t).__name__, 'us_per_sample': 1e6 * (time.perf_counter() - s_time) / n})
+    return results
+
+
+def bench_batch_transforms(batch_transform, images, repeats):
+    results = []
+    for t in batch_transform.transforms:
+        sec = timed(lambda: t(images), repeats)
+        results.append({'name': type(t).__name__, 'us_per_sample': 1e6 * sec / images.size(0)})
+        images = t(images)
+    return results
+
+
+def bench_sub_policies(images, n):
+    """Per-sample cost of each SubPolicy operation, and of each CIFAR10 sub-policy with its probabilities."""
+    samples = [Image.fromarray(img) for img in images[:n]]
+    ops = {}
+    for name in BatchCIFAR10Policy().ops:
+        op = SubPolicy(1.0, name, 5, 0.0, name, 5)
+        ops[name] = 1e6 * timed(lambda: [op(img) for img in samples], 1) / n
+    policies = []
+    for i, policy in enumerate(CIFAR10Policy().policies):
+        policies.append({'index': i, 'us_per_sample': 1e6 * timed(lambda: [policy(img) for img in samples], 1) / n})
+    return ops, policies
+
+
+def bench_batch_ops(images, repeats):
+    """Per-sample cost of each BatchCIFAR10Policy operation applied to the whole batch."""
+    policy = BatchCIFAR10Policy()
+    images = images.float()
+    b = images.size(0)
+    sign = torch.ones(b, device=images.device)
+    # mid-range magnitudes in the units of each op
+    magnitude_of = {'rotate': 15., 'posterize': 6., 'solarize': 128.}
+    ops = {}
+    for name in policy.ops:
+        m = torch.full((b,), magnitude_of.get(name, 0.3), device=images.device)
+        ops[name] = 1e6 * timed(lambda: policy.func[name](images, m, sign), repeats) / b
+    return ops
+
+
+def bench_loader(args, mode):
+    results = []
+    for workers, batch_size, pin_memory in itertools.product(args.workers, args.batch_sizes, args.pin_memory):
+        train_dataset, _, batch_transform = build_cifar(use_cifar10=True, batch_aug=mode != 'pil',
+                                                        shared=mode == 'shared')
+        loader = build_loader(train_dataset, batch_size, True, workers, pin_memory)
+        it = iter(loader)
+        samples = 0
+        for i in range(args.warmup + args.batches):
+            if i == args.warmup:
+                s_time = time.perf_counter()
+                samples = 0
+            images, _ = next(it)
+            if batch_transform is not None:
+                images = batch_transform(images.to(args.device, non_blocking=pin_memory))
+            samples += images.size(0)
+        if args.device.type == 'cuda':
+            torch.cuda.synchronize()
+        rate = samples / (time.perf_counter() - s_time)
+        del it
+        results.append({'mode': mode, 'workers': workers, 'batch_size': batch_size, 'pin_memory': pin_memory,
+                        'samples_per_sec': rate, 'samples_per_sec_per_worker': rate / max(workers, 1)})
+        print('{}\t workers={}\t batch_size={}\t pin_memory={}\t {:.0f} samples/s'.format(
+            mode, workers, batch_size, pin_memory, rate))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the CIFAR augmentation pipeline and data loading')
+    parser.add_argument('--out', default='bench_data.json', type=str, help='json results file')
+    parser.add_argument('--modes', default=['pil', 'batch', 'shared'], nargs='+', choices=['pil', 'batch', 'shared'],
+                        help='per-sample PIL pipeline, --batch_aug, or --shared_data')
+    parser.add_argument('--workers', default=[0, 2, 4, 8], type=int, nargs='+')
+    parser.add_argument('--batch_sizes', default=[128, 1024], type=int, nargs='+')
+    parser.add_argument('--pin_memory', default=[False, True], type=lambda s: s.lower() in ('1', 'true'), nargs='+')
+    parser.add_argument('--batches', default=20, type=int, help='timed batches per loader configuration')
+    parser.add_argument('--warmup', default=3, type=int, help='untimed batches, covers worker start-up')
+    parser.add_argument('--samples', default=1000, type=int, help='images used for the per-transform timings')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str,
+                        help='where the batch transforms run')
+    args = parser.parse_args()
+    args.device = torch.device(args.device)
+
+    report = {'config': {k: str(v) if k == 'device' else v for k, v in vars(args).items()}, 'torch': torch.__version__}
+    train_dataset, _, _ = build_cifar(use_cifar10=True)
+    report['transforms'] = bench_transforms(train_dataset, args.samples)
+    report['sub_policy_ops'], report['sub_policies'] = bench_sub_policies(train_dataset.data, args.samples)
+
+    images = torch.from_numpy(np.ascontiguousarray(train_dataset.data[:max(args.batch_sizes)])) \
+        .permute(0, 3, 1, 2).contiguous().to(args.device)
+    _, _, batch_transform = build_cifar(use_cifar10=True, batch_aug=True)
+    report['batch_transforms'] = bench_batch_transforms(batch_transform, images, 5)
+    report['batch_policy_ops'] = bench_batch_ops(images, 5)
+
+    report['loader'] = []
+    for mode in args.modes:
+        report['loader'] += bench_loader(args, mode)
+
+    for name, stats in (('transforms', report['transforms']), ('batch transforms', report['batch_transforms'])):
+        for t in stats:
+            print('{}: {}\t {:.1f}us/sample'.format(name, t['name'], t['us_per_sample']))
+    slowest = max(report['sub_policy_ops'], key=report['sub_policy_ops'].get)
+    print('slowest SubPolicy op: {} ({:.1f}us/sample)'.format(slowest, report['sub_policy_ops'][slowest]))
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,135 @@
+import atexit
+import glob
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def get_rng_state():
+    """The generators seeded by seed_all, so a resumed run draws the same augmentations and shuffles."""
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(state, directory, epoch, keep=3):
+    """Write state to directory/checkpoint_{epoch}.pth and keep only the newest `keep` checkpoints.
+    The file is written under a temporary name and renamed, so a preempted save never leaves a truncated checkpoint.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'checkpoint_{:04d}.pth'.format(epoch))
+    atomic_save(state, path)
+    for old in list_checkpoints(directory)[:-keep] if keep > 0 else []:
+        os.remove(old)
+    return path
+
+
+def atomic_save(state, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def cpu_snapshot(obj):
+    """Copy every tensor in a (nested) state dict to cpu, so training can keep updating the originals."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+class AsyncCheckpointWriter(object):
+    """Runs save functions on a background thread with cpu snapshots of their state.
+    At most max_pending snapshots exist at once, counting the one being written; submit blocks before taking a
+    snapshot until a slot is free.
+    With max_pending=0 saves run synchronously in the caller.
+
+    Example:
+        >>> writer = AsyncCheckpointWriter(max_pending=2)
+        >>> writer.submit(atomic_save, model.state_dict(), 'res18.pth')
+        >>> writer.close()
+    """
+
+    def __init__(self, max_pending=2):
+        self.max_pending = max_pending
+        self.error = None
+        if max_pending > 0:
+            # a slot is taken before the snapshot is copied and freed once it is written and dropped
+            self.slots = threading.BoundedSemaphore(max_pending)
+            self.queue = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+            self.thread.start()
+            # also flush when training exits through an exception
+            atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            fn, state, args = task
+            try:
+                fn(state, *args)
+            except Exception as e:
+                self.error = e
+            del task, state
+            self.slots.release()
+            self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('background checkpoint save failed') from error
+
+    def submit(self, fn, state, *args):
+        """Snapshot state to cpu and call fn(state, *args) in the background."""
+        self._raise()
+        if self.max_pending == 0:
+            return fn(state, *args)
+        self.slots.acquire()
+        self.queue.put((fn, cpu_snapshot(state), args))
+
+    def flush(self):
+        if self.max_pending > 0:
+            self.queue.join()
+        self._raise()
+
+    def close(self):
+        if self.max_pending > 0 and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise()
+
+
+def list_checkpoints(directory):
+    return sorted(glob.glob(os.path.join(directory, 'checkpoint_*.pth')))
+
+
+def latest_checkpoint(directory):
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if checkpoints else None
+
+
+def load_checkpoint(path, map_location='cpu'):
+    # the rng and numpy states are not plain tensors
+    return torch.load(path, map_location=map_location, weights_only=False)
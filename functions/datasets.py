@@ -0,0 +1,151 @@
+import torch
+import torch.distributed as dist
+import torchvision.transforms as transforms
+from torch.utils.data import Dataset, DataLoader, Sampler, BatchSampler, RandomSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
+from torchvision.datasets import CIFAR10, CIFAR100
+from functions.autoaug import CIFAR10Policy, BatchCIFAR10Policy, BatchCutout, BatchRandomCropFlip, Cutout
+
+
+class SharedCIFAR(Dataset):
+    """Decoded CIFAR images held as one uint8 tensor in shared memory.
+    Indexed with a list of indices (see batch_sampler), so each worker fetch returns a whole batch
+    and workers read the same buffer instead of holding their own copy of the dataset.
+    Args:
+        data (ndarray): uint8 images of size (N, H, W, C), as in torchvision's CIFAR10.data.
+        targets (list): Class labels.
+        transform (callable): Per-sample transform on a uint8 tensor of size (C, H, W).
+        batch_transform (callable): Transform on the stacked tensor of size (B, C, H, W).
+    """
+
+    def __init__(self, data, targets, transform=None, batch_transform=None):
+        self.data = torch.from_numpy(data).permute(0, 3, 1, 2).contiguous().share_memory_()
+        self.targets = torch.as_tensor(targets, dtype=torch.long).share_memory_()
+        self.transform = transform
+        self.batch_transform = batch_transform
+
+    @classmethod
+    def from_dataset(cls, dataset, transform=None, batch_transform=None):
+        return cls(dataset.data, dataset.targets, transform, batch_transform)
+
+    def __len__(self):
+        return self.data.size(0)
+
+    def __getitem__(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        images = self.data[indices]
+        if self.transform is not None:
+            images = torch.stack([self.transform(img) for img in images])
+        if self.batch_transform is not None:
+            images = self.batch_transform(images)
+        return images, self.targets[indices]
+
+
+class ShardSampler(Sampler):
+    """Every world_size-th index starting at the rank. Unlike DistributedSampler nothing is padded,
+    so a sharded evaluation counts every sample exactly once.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        self.num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+        self.rank = dist.get_rank() if rank is None else rank
+        self.indices = range(self.rank, len(dataset), self.num_replicas)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def distributed_sampler(dataset, shuffle):
+    # shuffled training shards are padded to equal length, evaluation shards are exact
+    return DistributedSampler(dataset, shuffle=True) if shuffle else ShardSampler(dataset)
+
+
+def batch_sampler(dataset, batch_size, shuffle=False, drop_last=False, distributed=False):
+    """Sampler yielding index lists; use with DataLoader(dataset, sampler=..., batch_size=None)."""
+    if distributed:
+        sampler = distributed_sampler(dataset, shuffle)
+    else:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return BatchSampler(sampler, batch_size, drop_last)
+
+
+def build_loader(dataset, batch_size, shuffle, workers, pin_memory, distributed=False):
+    """With distributed=True every rank loads its own shard and batch_size is the per-rank batch size."""
+    if isinstance(dataset, SharedCIFAR):
+        # the dataset returns whole batches, so the loader only hands out index lists
+        return DataLoader(dataset, batch_size=None,
+                          sampler=batch_sampler(dataset, batch_size, shuffle, distributed=distributed),
+                          num_workers=workers, pin_memory=pin_memory)
+    if distributed:
+        return DataLoader(dataset, batch_size=batch_size, sampler=distributed_sampler(dataset, shuffle),
+                          num_workers=workers, pin_memory=pin_memory)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=workers, pin_memory=pin_memory)
+
+
+def set_epoch(loader, epoch):
+    """Reshuffle the shards of a distributed loader for a new epoch."""
+    sampler = loader.sampler.sampler if isinstance(loader.sampler, BatchSampler) else loader.sampler
+    if isinstance(sampler, DistributedSampler):
+        sampler.set_epoch(epoch)
+
+
+def build_cifar(use_cifar10=True, download=True, normalize=True, batch_aug=False, shared=False):
+    aug = [transforms.RandomCrop(32, padding=4),
+           transforms.RandomHorizontalFlip(),
+           CIFAR10Policy(),
+           transforms.ToTensor(),
+           Cutout(n_holes=1, length=16)]
+    batch_transforms = []
+    batch_aug = batch_aug or shared
+    if batch_aug:
+        # workers only hand back raw uint8 batches, the whole pipeline runs after collation
+        aug = [transforms.PILToTensor()]
+        batch_transforms = [BatchRandomCropFlip(32, padding=4),
+                            BatchCIFAR10Policy(),
+                            transforms.ConvertImageDtype(torch.float),
+                            BatchCutout(n_holes=1, length=16)]
+    post = batch_transforms if batch_aug else aug
+
+    if use_cifar10:
+        if normalize:
+            post.append(
+                transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)), )
+
+        transform_train = transforms.Compose(aug)
+        transform_test = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize(
+                (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
+        ])
+        train_dataset = CIFAR10(root='./data',
+                                train=True, download=download, transform=transform_train)
+        val_dataset = CIFAR10(root='./data',
+                              train=False, download=download, transform=transform_test)
+
+    else:
+        if normalize:
+
+            post.append(
+                transforms.Normalize(
+                    (0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761)),
+            )
+        transform_train = transforms.Compose(aug)
+        transform_test = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize(
+                (0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761)),
+        ])
+        train_dataset = CIFAR100(root='data',
+                                 train=True, download=download, transform=transform_train)
+        val_dataset = CIFAR100(root='data',
+                               train=False, download=download, transform=transform_test)
+
+    train_batch_transform = transforms.Compose(batch_transforms) if batch_aug else None
+    if shared:
+        train_dataset = SharedCIFAR.from_dataset(train_dataset)
+        val_dataset = SharedCIFAR.from_dataset(val_dataset, batch_transform=transforms.Compose(
+            [transforms.ConvertImageDtype(torch.float), transform_test.transforms[-1]]))
+    return train_dataset, val_dataset, train_batch_transform
@@ -0,0 +1,52 @@
+import builtins
+import os
+
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo'):
+    """Join the process group described by torchrun's environment variables.
+    Returns (rank, world_size, local_rank), (0, 1, 0) when not launched by torchrun.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return 0, 1, 0
+    dist.init_process_group(backend)
+    return dist.get_rank(), dist.get_world_size(), int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def setup_for_distributed(is_master):
+    """Silence print on every rank but the first; print(..., force=True) still goes through."""
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_master or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+def all_gather_object(obj):
+    """List of obj from every rank, [obj] in a single process."""
+    if not is_distributed():
+        return [obj]
+    objects = [None] * dist.get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def broadcast_object(obj, src=0):
+    """obj of rank src on every rank, obj itself in a single process."""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src)
+    return objects[0]
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 import random
 import os
 import numpy as np
@@ -17,6 +18,80 @@ def seed_all(seed=1029):
     torch.backends.cudnn.deterministic = True
 
 
+class MetricAccumulator(object):
+    """Running sums kept on the training device, only synchronized with the host when read."""
+
+    def __init__(self, names, device):
+        self.names = list(names)
+        self.sums = torch.zeros(len(self.names), dtype=torch.float64, device=device)
+        self.count = 0
+
+    def update(self, n, **values):
+        self.sums += torch.stack([torch.as_tensor(values[name], device=self.sums.device).to(self.sums.dtype)
+                                  for name in self.names])
+        self.count += n
+
+    def all_reduce(self):
+        # sums and counts over every process of a distributed run
+        stats = torch.cat([self.sums, self.sums.new_tensor([self.count])])
+        dist.all_reduce(stats)
+        self.sums, self.count = stats[:-1], int(stats[-1].item())
+
+    def average(self):
+        sums = self.sums.tolist()
+        return {name: v / max(self.count, 1) for name, v in zip(self.names, sums)}
+
+
+def compute_loss(model, input, target, criterion=nn.CrossEntropyLoss(), alpha=0.1, beta=1e-6, temperature=3,
+                 return_outputs=False):
+
+    def kd_loss_function(output, target_output):
+        output = output / temperature
+        output_log_softmax = torch.log_softmax(output, dim=1)
+        loss_kd = -torch.mean(torch.sum(output_log_softmax * target_output, dim=1))
+        return loss_kd
+
+    def feature_loss_function(fea, target_fea):
+        loss = (fea - target_fea) ** 2 * ((fea > 0) | (target_fea > 0)).float()
+        return torch.abs(loss).sum()
+
+    def get_logits(output):
+        logits = output / temperature
+        logits = torch.softmax(logits, dim=1)
+        return logits
+
+    ann_outs, snn_outs = model(input)
+
+    loss = criterion(ann_outs[0], target) + criterion(snn_outs[0], target)
+
+    middle1_loss = criterion(ann_outs[1], target) + criterion(snn_outs[1], target)
+    middle2_loss = criterion(ann_outs[2], target) + criterion(snn_outs[2], target)
+    middle3_loss = criterion(ann_outs[3], target) + criterion(snn_outs[3], target)
+
+    logit4 = get_logits(ann_outs[0])
+    loss1by4 = (kd_loss_function(ann_outs[1], logit4.detach())) * (temperature ** 2)
+    loss2by4 = (kd_loss_function(ann_outs[2], logit4.detach())) * (temperature ** 2)
+    loss3by4 = (kd_loss_function(ann_outs[3], logit4.detach())) * (temperature ** 2)
+
+    loss1by1 = (kd_loss_function(snn_outs[1], get_logits(ann_outs[1]).detach())) * (temperature ** 2)
+    loss2by2 = (kd_loss_function(snn_outs[2], get_logits(ann_outs[2]).detach())) * (temperature ** 2)
+    loss3by3 = (kd_loss_function(snn_outs[3], get_logits(ann_outs[3]).detach())) * (temperature ** 2)
+    loss4by4 = (kd_loss_function(snn_outs[0], get_logits(ann_outs[0]).detach())) * (temperature ** 2)
+
+    feature_loss_1 = feature_loss_function(snn_outs[4], ann_outs[4].detach())
+    feature_loss_2 = feature_loss_function(snn_outs[5], ann_outs[5].detach())
+    feature_loss_3 = feature_loss_function(snn_outs[6], ann_outs[6].detach())
+    feature_loss_4 = feature_loss_function(snn_outs[7], ann_outs[7].detach())
+
+    total_loss = (1 - alpha) * (loss + middle1_loss + middle2_loss + middle3_loss) + \
+                 alpha * (loss1by4 + loss2by4 + loss3by4 + loss1by1 + loss2by2 + loss3by3 + loss4by4) + \
+                 beta * (feature_loss_1 + feature_loss_2 + feature_loss_3 + feature_loss_4)
+
+    if return_outputs:
+        return total_loss, ann_outs, snn_outs
+    return total_loss
+
+
 def get_logger(filename, verbosity=1, name=None):
     level_dict = {0: logging.DEBUG, 1: logging.INFO, 2: logging.WARNING}
     formatter = logging.Formatter(
@@ -1,17 +1,25 @@
 import argparse
+import contextlib
+import json
 import shutil
 import os
 import time
 import torch
 import logging as logger
-import torch.nn as nn
 from torch import autocast
 from torch.cuda.amp import GradScaler
-from models.resnet import multi_resnet18_kd
-from functions import seed_all
-import torchvision.transforms as transforms
-from torchvision.datasets import CIFAR10, CIFAR100
-from functions.autoaug import CIFAR10Policy, Cutout
+from torch.nn.parallel import DistributedDataParallel
+from models.resnet import multi_resnet18_kd, convert_sync_batchnorm
+from models.spike_storage import packed_spike_storage
+from models.spike_stats import SpikeMonitor
+from models.profiler import StepProfiler
+from models.capture import CaptureResNet
+from functions import seed_all, MetricAccumulator, compute_loss
+from functions.datasets import build_cifar, build_loader, set_epoch
+from functions.distributed import init_distributed, is_distributed, is_main_process, setup_for_distributed, \
+    all_gather_object, broadcast_object
+from functions.checkpoint import get_rng_state, set_rng_state, save_checkpoint, latest_checkpoint, load_checkpoint, \
+    atomic_save, AsyncCheckpointWriter
 from tqdm import tqdm
 
 
@@ -34,184 +42,398 @@ parser.add_argument('-T', '--time', default=4, type=int, metavar='N',
                     help='snn simulation time (default: 4)')
 parser.add_argument('--amp', action='store_false',
                     help='if use amp training.')
+parser.add_argument('--amp_dtype', default=None, choices=['float16', 'bfloat16'],
+                    help='autocast dtype (default: float16 on cuda, bfloat16 on cpu).')
+parser.add_argument('--check_precision', action='store_true',
+                    help='before training, report per LIF layer how often autocast flips a spike of the float32 run.')
+parser.add_argument('--log_interval', default=50, type=int,
+                    help='steps between training metric updates on the progress bar.')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str,
+                    help='training device (default: cuda if available).')
+parser.add_argument('--batch_aug', action='store_true',
+                    help='run the train augmentation on whole uint8 batches on the training device.')
+parser.add_argument('--shared_data', action='store_true',
+                    help='keep decoded CIFAR in shared memory and load whole index batches (implies --batch_aug).')
+parser.add_argument('--multi_step', action='store_true',
+                    help='run the T snn timesteps as one time-batched pass.')
+parser.add_argument('--fused_lif', action='store_true',
+                    help='use the fused LIF kernel over all timesteps (with --multi_step).')
+parser.add_argument('--detach_reset', action='store_true',
+                    help='no gradient through the LIF reset, --fused_lif then saves 2-bit flags instead of membranes.')
+parser.add_argument('--fused_joint', action='store_true',
+                    help='run the ann pass and the T snn timesteps of a training step as one [B*(T+1), ...] batch '
+                         '(only with factorized convs, see --ranks).')
+parser.add_argument('--pack_spikes', action='store_true',
+                    help='store spikes saved for backward as 1-bit packed tensors.')
+parser.add_argument('--resume', default='', type=str,
+                    help='checkpoint to resume from, or "auto" for the newest one in --checkpoint_dir.')
+parser.add_argument('--checkpoint_dir', default='checkpoints', type=str,
+                    help='directory of the full training state checkpoints.')
+parser.add_argument('--save_every', default=1, type=int,
+                    help='epochs between full training state checkpoints (0 disables them).')
+parser.add_argument('--keep_checkpoints', default=3, type=int,
+                    help='number of most recent checkpoints kept in --checkpoint_dir.')
+parser.add_argument('--max_pending_saves', default=2, type=int,
+                    help='checkpoint snapshots queued for the background writer (0 saves synchronously).')
+parser.add_argument('--dist_backend', default='gloo', type=str,
+                    help='process group backend when launched with torchrun.')
+parser.add_argument('--sync_bn', default='none', choices=['none', 'ann', 'snn', 'all'],
+                    help='all-reduce the BatchNorm statistics of these ASBatchNorm2d branches across processes.')
+parser.add_argument('--eval_heads', action='store_true',
+                    help='also report the ann and every middle head accuracy in the test pass.')
+parser.add_argument('--evaluate', action='store_true',
+                    help='only evaluate the --pretrained model.')
+parser.add_argument('--pretrained', default='res18.pth', type=str,
+                    help='model state dict used by --evaluate.')
+parser.add_argument('--spike_report', default='', type=str,
+                    help='json file for per-layer spike rates, synaptic operations and energy of the test pass.')
+parser.add_argument('--capture', default='none', choices=['none', 'eager', 'script', 'inductor'],
+                    help='train through the stateless CaptureResNet, scripted or compiled with torch.compile.')
+parser.add_argument('--ranks', default=[], type=str, nargs='*',
+                    help='truncate the ASConv2d factorizations, e.g. layer3=64 layer4=128 (module name prefix=rank).')
+parser.add_argument('--rank_energy', default=None, type=float,
+                    help='truncate the other ASConv2d layers to the rank holding this fraction of the spectrum.')
+parser.add_argument('--profile_steps', default=0, type=int,
+                    help='profile this many training steps per module, ann/snn mode and timestep, then exit.')
+parser.add_argument('--profile_out', default='profile', type=str,
+                    help='prefix of the profile table (.json) and chrome trace (_trace.json).')
+parser.add_argument('--exit_thresholds', default=[], type=float, nargs='*',
+                    help='softmax margins swept by the early-exit evaluation.')
+parser.add_argument('--exit_report', default='', type=str,
+                    help='json file for the early-exit accuracy/compute curve.')
+parser.add_argument('--adaptive_thresholds', default=[], type=float, nargs='*',
+                    help='softmax margins swept by the adaptive-timestep evaluation.')
+parser.add_argument('--adaptive_patience', default=0, type=int,
+                    help='also stop a sample once its prediction is unchanged for this many timesteps.')
 args = parser.parse_args()
 
 
-def build_cifar(use_cifar10=True, download=True, normalize=True):
-    aug = [transforms.RandomCrop(32, padding=4),
-           transforms.RandomHorizontalFlip(),
-           CIFAR10Policy(),
-           transforms.ToTensor(),
-           Cutout(n_holes=1, length=16)]
-
-    if use_cifar10:
-        if normalize:
-            aug.append(
-                transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)), )
-
-        transform_train = transforms.Compose(aug)
-        transform_test = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize(
-                (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
-        ])
-        train_dataset = CIFAR10(root='./data',
-                                train=True, download=download, transform=transform_train)
-        val_dataset = CIFAR10(root='./data',
-                              train=False, download=download, transform=transform_test)
-
-    else:
-        if normalize:
-
-            aug.append(
-                transforms.Normalize(
-                    (0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761)),
-            )
-        transform_train = transforms.Compose(aug)
-        transform_test = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize(
-                (0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761)),
-        ])
-        train_dataset = CIFAR100(root='data',
-                                 train=True, download=download, transform=transform_train)
-        val_dataset = CIFAR100(root='data',
-                               train=False, download=download, transform=transform_test)
-
-    return train_dataset, val_dataset
-
-
-def compute_loss(model, input, target, criterion=nn.CrossEntropyLoss(), alpha=0.1, beta=1e-6, temperature=3):
-
-    def kd_loss_function(output, target_output):
-        output = output / temperature
-        output_log_softmax = torch.log_softmax(output, dim=1)
-        loss_kd = -torch.mean(torch.sum(output_log_softmax * target_output, dim=1))
-        return loss_kd
-
-    def feature_loss_function(fea, target_fea):
-        loss = (fea - target_fea) ** 2 * ((fea > 0) | (target_fea > 0)).float()
-        return torch.abs(loss).sum()
-
-    def get_logits(output):
-        logits = output / temperature
-        logits = torch.softmax(logits, dim=1)
-        return logits
-
-    ann_outs, snn_outs = model(input)
-
-    loss = criterion(ann_outs[0], target) + criterion(snn_outs[0], target)
-
-    middle1_loss = criterion(ann_outs[1], target) + criterion(snn_outs[1], target)
-    middle2_loss = criterion(ann_outs[2], target) + criterion(snn_outs[2], target)
-    middle3_loss = criterion(ann_outs[3], target) + criterion(snn_outs[3], target)
-
-    logit4 = get_logits(ann_outs[0])
-    loss1by4 = (kd_loss_function(ann_outs[1], logit4.detach())) * (temperature ** 2)
-    loss2by4 = (kd_loss_function(ann_outs[2], logit4.detach())) * (temperature ** 2)
-    loss3by4 = (kd_loss_function(ann_outs[3], logit4.detach())) * (temperature ** 2)
-
-    loss1by1 = (kd_loss_function(snn_outs[1], get_logits(ann_outs[1]).detach())) * (temperature ** 2)
-    loss2by2 = (kd_loss_function(snn_outs[2], get_logits(ann_outs[2]).detach())) * (temperature ** 2)
-    loss3by3 = (kd_loss_function(snn_outs[3], get_logits(ann_outs[3]).detach())) * (temperature ** 2)
-    loss4by4 = (kd_loss_function(snn_outs[0], get_logits(ann_outs[0]).detach())) * (temperature ** 2)
-
-    feature_loss_1 = feature_loss_function(snn_outs[4], ann_outs[4].detach())
-    feature_loss_2 = feature_loss_function(snn_outs[5], ann_outs[5].detach())
-    feature_loss_3 = feature_loss_function(snn_outs[6], ann_outs[6].detach())
-    feature_loss_4 = feature_loss_function(snn_outs[7], ann_outs[7].detach())
-
-    total_loss = (1 - alpha) * (loss + middle1_loss + middle2_loss + middle3_loss) + \
-                 alpha * (loss1by4 + loss2by4 + loss3by4 + loss1by1 + loss2by2 + loss3by3 + loss4by4) + \
-                 beta * (feature_loss_1 + feature_loss_2 + feature_loss_3 + feature_loss_4)
-
-    return total_loss
-
-
-def train(model, device, train_loader, optimizer, epoch, scaler, args):
-    running_loss = 0
+def train_step(model, device, images, labels, optimizer, scaler, args, batch_transform=None,
+               region=lambda name: contextlib.nullcontext()):
+    """One optimizer step on a batch already on device, region(name) wraps its phases so a StepProfiler can time
+    them."""
+    optimizer.zero_grad()
+    if batch_transform is not None:
+        with region('batch_transform'):
+            images = batch_transform(images)
+
+    spike_storage = packed_spike_storage() if args.pack_spikes else contextlib.nullcontext()
+    amp = autocast(device_type=device.type, dtype=getattr(torch, args.amp_dtype)) if args.amp \
+        else contextlib.nullcontext()
+    with amp, spike_storage, region('compute_loss'):
+        # loss = model.train_forward_ann(images, labels)
+        loss, ann_outs, snn_outs = compute_loss(model, images, labels, return_outputs=True)
+    with region('backward'):
+        if scaler is not None:
+            scaler.scale(loss).backward()
+        else:
+            loss.backward()
+    with region('optimizer'):
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
+    return loss, ann_outs, snn_outs
+
+
+def train(model, device, train_loader, optimizer, epoch, scaler, args, batch_transform=None):
     model.train()
     M = len(train_loader)
-    total = 0
-    correct = 0
+    # summed on device, read back every args.log_interval steps
+    metrics = MetricAccumulator(['loss', 'snn_correct', 'ann_correct'], device)
     s_time = time.time()
-    progress_bar = tqdm(train_loader, desc='Epoch {}/{}'.format(epoch, 0), leave=False)
+    progress_bar = tqdm(train_loader, desc='Epoch {}/{}'.format(epoch, 0), leave=False, disable=not is_main_process())
     for i, (images, labels) in enumerate(progress_bar):
-        optimizer.zero_grad()
         labels = labels.to(device)
         images = images.to(device)
+        loss, ann_outs, snn_outs = train_step(model, device, images, labels, optimizer, scaler, args,
+                                              batch_transform)
 
-        if args.amp:
-            with autocast(device_type='cuda', dtype=torch.float16):
-                # loss = model.train_forward_ann(images, labels)
-                loss = compute_loss(model, images, labels)
-                scaler.scale(loss).backward()
-                scaler.step(optimizer)
-                scaler.update()
-        else:
-            loss = compute_loss(model, images, labels)
-            loss.backward()
-            optimizer.step()
+        n = labels.size(0)
+        metrics.update(n, loss=loss.detach() * n, snn_correct=snn_outs[0].argmax(1).eq(labels).sum(),
+                       ann_correct=ann_outs[0].argmax(1).eq(labels).sum())
 
-        running_loss += loss.item()
-        total += float(labels.size(0))
-      
         # 更新进度条的状态
-        progress_bar.set_postfix(loss=running_loss / total, acc=100 * correct / total)
+        if (i + 1) % args.log_interval == 0:
+            avg = metrics.average()
+            progress_bar.set_postfix(loss=avg['loss'], acc=100 * avg['snn_correct'])
     progress_bar.close()
-  
+
+    if is_distributed():
+        metrics.all_reduce()
+    avg = metrics.average()
     e_time = time.time()
-    return running_loss / total, 100 * correct / total, (e_time-s_time)/60
+    return avg['loss'], 100 * avg['snn_correct'], 100 * avg['ann_correct'], (e_time-s_time)/60
+
+
+def profile(model, train_model, device, train_loader, optimizer, scaler, args, batch_transform=None):
+    """Run args.profile_steps training steps under a StepProfiler, the first one only warms up."""
+    model.train()
+    loader = iter(train_loader)
+    images, labels = next(loader)
+    train_step(train_model, device, images.to(device), labels.to(device), optimizer, scaler, args, batch_transform)
+    with StepProfiler(model) as profiler:
+        for _ in range(args.profile_steps):
+            try:
+                images, labels = next(loader)
+            except StopIteration:
+                loader = iter(train_loader)
+                images, labels = next(loader)
+            with profiler.region('step'):
+                train_step(train_model, device, images.to(device), labels.to(device), optimizer, scaler, args,
+                           batch_transform, profiler.region)
+    return profiler
+
+
+@torch.no_grad()
+def check_spike_precision(model, images, device, dtype):
+    """Run the snn on the same batch in float32 and under autocast with dtype.
+    Returns the fraction of spikes that differ between the two runs for every LIF layer.
+    """
+    names = {m: name for name, m in model.named_modules()}
+    runs = []
+
+    def record(spikes):
+        def hook(m, inputs, output):
+            spikes.setdefault(m, []).append(output.detach().float())
+        return hook
+
+    model.eval()
+    for amp in (False, True):
+        spikes = {}
+        handles = [m.register_forward_hook(record(spikes)) for m in model.lif_neurons]
+        with autocast(device_type=device.type, dtype=dtype, enabled=amp):
+            model(images.to(device), True)
+        for handle in handles:
+            handle.remove()
+        runs.append(spikes)
+    return {names[m]: torch.cat(runs[0][m]).ne(torch.cat(runs[1][m])).float().mean().item() for m in runs[0]}
 
 
 @torch.no_grad()
-def test(model, test_loader, device):
-    correct = 0
-    total = 0
+def test(model, test_loader, device, all_heads=False):
+    """Accuracy of the final snn head, with all_heads also of the ann and the middle heads of both.
+    Counts stay on device and are summed over the ranks of a sharded test_loader once at the end.
+    """
+    names = ['snn']
+    if all_heads:
+        names = ['snn', 'snn_head1', 'snn_head2', 'snn_head3', 'ann', 'ann_head1', 'ann_head2', 'ann_head3']
+    # one slot per head plus the sample count
+    stats = torch.zeros(len(names) + 1, dtype=torch.float64, device=device)
     model.eval()
-    for batch_idx, (inputs, targets) in enumerate(test_loader):
-        inputs = inputs.to(device)
-        outputs = model(inputs, True)[0]
-        _, predicted = outputs.cpu().max(1)
-        total += float(targets.size(0))
-        correct += float(predicted.eq(targets).sum().item())
+    for inputs, targets in test_loader:
+        inputs = inputs.to(device, non_blocking=True)
+        targets = targets.to(device, non_blocking=True)
+        if all_heads:
+            ann_outs, snn_outs = model(inputs)
+            logits = list(snn_outs[:4]) + list(ann_outs[:4])
+        else:
+            logits = [model(inputs, True)[0]]
+        stats[:-1] += torch.stack([out.argmax(1).eq(targets).sum() for out in logits])
+        stats[-1] += targets.size(0)
+    if is_distributed():
+        torch.distributed.all_reduce(stats)
+    stats = stats.tolist()
+    return {name: 100 * correct / stats[-1] for name, correct in zip(names, stats[:-1])}
 
-    final_acc = 100 * correct / total
-    return final_acc
+
+@torch.no_grad()
+def test_early_exit(model, test_loader, device, thresholds):
+    model.eval()
+    costs = model.exit_macs()
+    # MACs of a sample leaving at exit i: backbone up to i plus every head evaluated on the way
+    exit_cost = [sum(stage for stage, _ in costs[:i + 1]) + sum(head for _, head in costs[:i + 1]) for i in range(4)]
+    full_cost = sum(stage + head for stage, head in costs)
+    curve = []
+    for threshold in thresholds:
+        correct = 0
+        total = 0
+        exit_counts = torch.zeros(4, dtype=torch.long)
+        for inputs, targets in test_loader:
+            logits, exits = model.early_exit_forward(inputs.to(device), threshold)
+            correct += logits.argmax(1).cpu().eq(targets).sum().item()
+            total += targets.size(0)
+            exit_counts += torch.bincount(exits.cpu(), minlength=4)
+        exit_frac = (exit_counts.float() / total).tolist()
+        rel_cost = sum(f * c for f, c in zip(exit_frac, exit_cost)) / full_cost
+        curve.append({'threshold': threshold, 'acc': 100 * correct / total,
+                      'exit_fraction': exit_frac, 'relative_macs': rel_cost})
+        print('Early exit threshold={:.3f}\t acc={:.3f}\t relative MACs={:.3f}\t exits={}'.format(
+            threshold, 100 * correct / total, rel_cost, ['{:.3f}'.format(f) for f in exit_frac]))
+    return curve
+
+
+@torch.no_grad()
+def test_adaptive(model, test_loader, device, thresholds, patience=0):
+    model.eval()
+    curve = []
+    for threshold in thresholds:
+        correct = 0
+        total = 0
+        steps = 0
+        for inputs, targets in test_loader:
+            logits, used = model.adaptive_forward(inputs.to(device), threshold, patience)
+            correct += logits.argmax(1).cpu().eq(targets).sum().item()
+            total += targets.size(0)
+            steps += used.sum().item()
+        curve.append({'threshold': threshold, 'patience': patience, 'acc': 100 * correct / total,
+                      'avg_timesteps': steps / total})
+        print('Adaptive T threshold={:.3f}\t acc={:.3f}\t avg timesteps={:.3f}/{}'.format(
+            threshold, 100 * correct / total, steps / total, model.T))
+    return curve
 
 
 if __name__ == '__main__':
 
-    seed_all(args.seed)
-    train_dataset, val_dataset = build_cifar(use_cifar10=True)
-    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True,
-                                               num_workers=args.workers, pin_memory=True)
-    test_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False,
-                                              num_workers=args.workers, pin_memory=True)
+    rank, world_size, local_rank = init_distributed(args.dist_backend)
+    setup_for_distributed(rank == 0)
+    # every rank draws its own augmentations, DistributedSampler shuffles with its own shared seed
+    seed_all(args.seed + rank)
+    device = torch.device(args.device)
+    if device.type == 'cuda' and world_size > 1:
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+    # --batch_size is the total over all processes
+    batch_size = args.batch_size // world_size
+    if args.amp_dtype is None:
+        args.amp_dtype = 'float16' if device.type == 'cuda' else 'bfloat16'
+    train_dataset, val_dataset, batch_transform = build_cifar(use_cifar10=True, batch_aug=args.batch_aug,
+                                                              shared=args.shared_data)
+    train_loader = build_loader(train_dataset, batch_size, True, args.workers, device.type == 'cuda', world_size > 1)
+    test_loader = build_loader(val_dataset, batch_size, False, args.workers, device.type == 'cuda', world_size > 1)
 
     model = multi_resnet18_kd(num_classes=10)
+    ranks = {prefix: int(value) for prefix, value in (r.split('=') for r in args.ranks)}
+    if (ranks or args.rank_energy is not None) and not args.evaluate:
+        # before the optimizer is built, a resumed checkpoint then has the same shapes.
+        # Every rank starts from its own seed: the first one picks the ranks, DDP then broadcasts its weights
+        kept = model.truncate_rank(ranks, args.rank_energy) if rank == 0 else None
+        kept = broadcast_object(kept)
+        if rank != 0:
+            model.truncate_rank(kept)
+        print('ranks: {}'.format(kept))
     model.T = args.time
-    model.cuda()
-    device = next(model.parameters()).device
-
-    scaler = GradScaler() if args.amp else None
+    model.multi_step = args.multi_step
+    model.fused_lif = args.fused_lif
+    model.detach_reset = args.detach_reset
+    model.fused_joint = args.fused_joint
+    if args.fused_joint and not args.evaluate and not any(m.factorized for m in model.as_convs):
+        print('--fused_joint without factorized convs, running the ann and snn passes separately')
+    if args.sync_bn != 'none':
+        convert_sync_batchnorm(model, ('ann', 'snn') if args.sync_bn == 'all' else (args.sync_bn, ))
+    model.to(device)
+
+    if args.evaluate:
+        model.load_state_dict(torch.load(args.pretrained, map_location=device))
+        if ranks or args.rank_energy is not None:
+            print('ranks: {}'.format(model.truncate_rank(ranks, args.rank_energy)))
+        monitor = SpikeMonitor(model) if args.spike_report else contextlib.nullcontext()
+        with monitor:
+            accs = test(model, test_loader, device, args.eval_heads)
+        print('Test acc={:.3f}'.format(accs['snn']))
+        if args.spike_report:
+            monitor.save(args.spike_report)
+            total = monitor.report()['total']
+            print('SOPs={:.3e}\t MACs={:.3e}\t energy={:.3e}J vs ann {:.3e}J per sample'.format(
+                total['sops'], total['macs'], total['snn_energy_j'], total['ann_energy_j']))
+        if args.eval_heads:
+            print('\t '.join('{} acc={:.3f}'.format(name, acc) for name, acc in accs.items()))
+        if args.exit_thresholds:
+            curve = test_early_exit(model, test_loader, device, args.exit_thresholds)
+            if args.exit_report:
+                with open(args.exit_report, 'w') as f:
+                    json.dump(curve, f, indent=2)
+        if args.adaptive_thresholds:
+            test_adaptive(model, test_loader, device, args.adaptive_thresholds, args.adaptive_patience)
+        exit(0)
+
+    resume = latest_checkpoint(args.checkpoint_dir) if args.resume == 'auto' else args.resume
+    checkpoint = load_checkpoint(resume, map_location=device) if resume else None
+    if checkpoint is not None:
+        # before the optimizer is built: layers truncated to other ranks get new factor parameters
+        model.load_state_dict(checkpoint['model'])
+    # bfloat16 keeps the float32 exponent range and needs no loss scaling
+    scaler = GradScaler() if args.amp and args.amp_dtype == 'float16' and device.type == 'cuda' else None
+    if args.amp and args.check_precision:
+        # after the resumed model state is loaded, on one batch of the training set
+        images, _ = next(iter(train_loader))
+        if batch_transform is not None:
+            images = batch_transform(images.to(device))
+        mismatch = check_spike_precision(model, images[:64], device, getattr(torch, args.amp_dtype))
+        print('{} autocast vs float32 spike disagreement: max {:.2e}, mean {:.2e} over {} LIF layers'.format(
+            args.amp_dtype, max(mismatch.values()), sum(mismatch.values()) / len(mismatch), len(mismatch)))
+        print('\t '.join('{}={:.2e}'.format(name, fraction) for name, fraction in mismatch.items()))
 
     optimizer = torch.optim.SGD(model.parameters(), lr=0.1, weight_decay=5e-4)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, eta_min=0, T_max=args.epochs)
     best_acc = 0
     best_epoch = 0
+    if checkpoint is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+        if scaler is not None and checkpoint['scaler'] is not None:
+            scaler.load_state_dict(checkpoint['scaler'])
+        best_acc, best_epoch = checkpoint['best_acc'], checkpoint['best_epoch']
+        args.start_epoch = checkpoint['epoch'] + 1
+        # restored last, the setup above (spike precision check) also draws random numbers
+        rng = checkpoint['rng'] if isinstance(checkpoint['rng'], list) else [checkpoint['rng']]
+        if len(rng) == world_size:
+            set_rng_state(rng[rank])
+        else:
+            print('checkpoint has rng states of {} processes, not restored'.format(len(rng)))
+        print('resumed from {} at epoch {}'.format(resume, args.start_epoch))
+    train_model = model
+    if args.capture != 'none':
+        # shares the parameters and bn buffers of model, which keeps serving test() and the checkpoints
+        train_model = CaptureResNet(model)
+        if args.capture == 'script':
+            train_model = torch.jit.script(train_model)
+    if world_size > 1:
+        train_model = DistributedDataParallel(train_model,
+                                              device_ids=[local_rank] if device.type == 'cuda' else None)
+    if args.capture not in ('none', 'eager', 'script'):
+        train_model = torch.compile(train_model, backend=args.capture)
+    if args.profile_steps:
+        profiler = profile(model, train_model, device, train_loader, optimizer, scaler, args, batch_transform)
+        print(profiler.format_table())
+        if is_main_process():
+            profiler.save_table(args.profile_out + '.json')
+            profiler.save_trace(args.profile_out + '_trace.json')
+        exit(0)
+    # snapshots are copied to cpu and written by a background thread while training continues
+    writer = AsyncCheckpointWriter(args.max_pending_saves)
     print('start training!')
-    for epoch in range(args.epochs):
-
-        loss, acc, t_diff = train(model, device, train_loader, optimizer, epoch, scaler, args)
-        print('Epoch:[{}/{}]\t loss={:.5f}\t acc={:.3f},\t time elapsed: {}'.format(epoch, args.epochs, loss, acc,
-                                                                                    t_diff))
+    for epoch in range(args.start_epoch, args.epochs):
+        set_epoch(train_loader, epoch)
+        loss, acc, ann_acc, t_diff = train(train_model, device, train_loader, optimizer, epoch, scaler, args,
+                                           batch_transform)
+        print('Epoch:[{}/{}]\t loss={:.5f}\t acc={:.3f}\t ann acc={:.3f},\t time elapsed: {}'.format(
+            epoch, args.epochs, loss, acc, ann_acc, t_diff))
         scheduler.step()
-        facc = test(model, test_loader, device)
+        accs = test(model, test_loader, device, args.eval_heads)
+        facc = accs['snn']
         print('Epoch:[{}/{}]\t Test acc={:.3f}'.format(epoch, args.epochs, facc))
+        if args.eval_heads:
+            print('Epoch:[{}/{}]\t '.format(epoch, args.epochs) +
+                  '\t '.join('{} acc={:.3f}'.format(name, acc) for name, acc in accs.items()))
 
         if best_acc < facc:
             best_acc = facc
             best_epoch = epoch + 1
-            torch.save(model.state_dict(), 'res18.pth')
+            if is_main_process():
+                writer.submit(atomic_save, model.state_dict(), 'res18.pth')
         print('Best Test acc={:.3f}'.format(best_acc))
+
+        if args.save_every > 0 and ((epoch + 1) % args.save_every == 0 or epoch + 1 == args.epochs):
+            # every rank contributes its rng state, only the first one writes
+            rng = all_gather_object(get_rng_state())
+            if is_main_process():
+                state = {'epoch': epoch, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                         'scheduler': scheduler.state_dict(),
+                         'scaler': scaler.state_dict() if scaler is not None else None,
+                         'best_acc': best_acc, 'best_epoch': best_epoch, 'rng': rng, 'args': vars(args)}
+                writer.submit(save_checkpoint, state, args.checkpoint_dir, epoch, args.keep_checkpoints)
+    writer.close()
+    if is_distributed():
+        torch.distributed.destroy_process_group()
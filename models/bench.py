@@ -0,0 +1,178 @@
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+import torch
+from torch import autocast
+
+from models.resnet import LIFSpike, multi_resnet18_kd
+from functions import compute_loss
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and never decreases, so every case runs in a fresh process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def conv_case(model, x, y, cached, conv=None):
+    conv = conv or model.layer1[0].conv1
+    conv.use_ann = False
+
+    def step():
+        if not cached:
+            conv.clear_weight_cache()
+        return conv(x)
+    return step
+
+
+def low_rank_case(model, x, y, rank):
+    # a wide layer3 conv, where truncation pays off
+    conv = model.layer3[1].conv1
+    conv.truncate(rank)
+    return conv_case(model, x, y, True, conv)
+
+
+def lif_case(model, x, y, fused):
+    lif = LIFSpike()
+    lif.step_mode, lif.T, lif.fused = 'm', model.T, fused
+    x_seq = x.repeat_interleave(model.T, 0)
+    return lambda: lif(x_seq)
+
+
+def bn_case(model, x, y):
+    bn = model.layer1[0].bn1
+    bn.use_ann = False
+    return lambda: bn(x)
+
+
+def branch_case(model, x, y):
+    model.use_ann_mode_tag(True)
+    return lambda: model.bottleneck1_1(x)
+
+
+def one_time_case(model, x, y):
+    def step():
+        model.reset_neurons()
+        model.use_ann_mode_tag(True)
+        return model.one_time_forward(x)[0]
+    return step
+
+
+def loss_case(model, x, y):
+    def step():
+        model.zero_grad(set_to_none=True)
+        compute_loss(model, x, y).backward()
+    return step
+
+
+# name -> (builder, input channels of an isolated component or None for the image, always trains)
+CASES = {
+    'asconv_recompose': (lambda m, x, y: conv_case(m, x, y, False), 64, False),
+    'asconv_cached': (lambda m, x, y: conv_case(m, x, y, True), 64, False),
+    'asconv_layer3': (lambda m, x, y: low_rank_case(m, x, y, 256), 256, False),
+    'asconv_layer3_rank32': (lambda m, x, y: low_rank_case(m, x, y, 32), 256, False),
+    'lif': (lambda m, x, y: lif_case(m, x, y, False), 64, False),
+    'lif_fused': (lambda m, x, y: lif_case(m, x, y, True), 64, False),
+    'asbatchnorm': (bn_case, 64, False),
+    'branch_bottleneck': (branch_case, 64, False),
+    'one_time_forward': (one_time_case, None, False),
+    'forward_joint': (lambda m, x, y: lambda: m(x)[1][0], None, False),
+    'forward_snn_only': (lambda m, x, y: lambda: m(x, True)[0], None, False),
+    'compute_loss': (loss_case, None, True),
+}
+
+
+def run_case(name, batch_size, T, threads, dtype, args):
+    build, channels, trains = CASES[name]
+    torch.set_num_threads(threads)
+    model = multi_resnet18_kd(num_classes=10)
+    model.T = T
+    model.multi_step = args.multi_step
+    model.fused_lif = args.fused_lif
+    model.fused_joint = args.fused_joint
+    if args.ranks:
+        model.truncate_rank({prefix: int(rank) for prefix, rank in (r.split('=') for r in args.ranks)})
+    model.train()
+    model.reset_neurons()
+    size = (batch_size, 3, 32, 32) if channels is None else (batch_size, channels, 32, 32)
+    # components without parameters (lif) need a differentiable input for --backward
+    x = torch.randn(size, requires_grad=args.backward and channels is not None)
+    y = torch.randint(10, (batch_size, ))
+    step = build(model, x, y)
+    amp = autocast(device_type='cpu', dtype=getattr(torch, dtype)) if dtype != 'float32' else contextlib.nullcontext()
+    grad = contextlib.nullcontext() if trains or args.backward else torch.no_grad()
+
+    def run():
+        with grad, amp:
+            out = step()
+        if out is not None and args.backward:
+            out.float().sum().backward()
+
+    rss = peak_rss_mb()
+    for _ in range(args.warmup):
+        run()
+    times = []
+    for _ in range(args.iters):
+        s_time = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - s_time)
+    times = np.array(times) * 1000
+    result = {'case': name, 'batch_size': batch_size, 'T': T, 'threads': threads, 'dtype': dtype,
+              'p50_ms': float(np.percentile(times, 50)), 'p90_ms': float(np.percentile(times, 90)),
+              'p99_ms': float(np.percentile(times, 99)), 'samples_per_sec': batch_size / (times.mean() / 1000),
+              'peak_rss_growth_mb': peak_rss_mb() - rss}
+    print('{:<18s} B={:<4d} T={} threads={:<2d} {:<8s} p50={:.2f}ms p90={:.2f}ms {:.0f} samples/s'.format(
+        name, batch_size, T, threads, dtype, result['p50_ms'], result['p90_ms'], result['samples_per_sec']))
+    return result
+
+
+def compare(results, baseline):
+    """p50 speedup of every configuration also present in the baseline (> 1 is faster)."""
+    key = lambda r: (r['case'], r['batch_size'], r['T'], r['threads'], r['dtype'])
+    reference = {key(r): r for r in baseline['results']}
+    rows = []
+    for r in results:
+        ref = reference.get(key(r))
+        if ref is None:
+            continue
+        rows.append({'case': r['case'], 'batch_size': r['batch_size'], 'T': r['T'], 'threads': r['threads'],
+                     'dtype': r['dtype'], 'baseline_p50_ms': ref['p50_ms'], 'p50_ms': r['p50_ms'],
+                     'speedup': ref['p50_ms'] / r['p50_ms']})
+        print('{:<18s} B={:<4d} T={} threads={:<2d} {:<8s} {:.2f}ms -> {:.2f}ms  x{:.2f}'.format(
+            *key(r), ref['p50_ms'], r['p50_ms'], ref['p50_ms'] / r['p50_ms']))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU microbenchmarks of the Multi_ResNet training hot paths')
+    parser.add_argument('--cases', default=list(CASES), nargs='+', choices=list(CASES))
+    parser.add_argument('--batch_sizes', default=[32], type=int, nargs='+')
+    parser.add_argument('-T', '--time', default=[4], type=int, nargs='+', help='snn simulation times')
+    parser.add_argument('--threads', default=[torch.get_num_threads()], type=int, nargs='+')
+    parser.add_argument('--dtypes', default=['float32', 'bfloat16'], nargs='+', choices=['float32', 'bfloat16'],
+                        help='bfloat16 runs under cpu autocast')
+    parser.add_argument('--iters', default=20, type=int)
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--backward', action='store_true', help='also time the backward of every component')
+    parser.add_argument('--multi_step', action='store_true')
+    parser.add_argument('--fused_lif', action='store_true')
+    parser.add_argument('--fused_joint', action='store_true')
+    parser.add_argument('--ranks', default=[], type=str, nargs='*', help='truncated ranks, e.g. layer3=64')
+    parser.add_argument('--out', default='bench_model.json', type=str, help='json results file')
+    parser.add_argument('--baseline', default='', type=str, help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    configs = itertools.product(args.cases, args.batch_sizes, args.time, args.threads, args.dtypes)
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        results = [pool.apply(run_case, config + (args, )) for config in configs]
+    report = {'config': vars(args), 'torch': torch.__version__, 'results': results}
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compare(results, json.load(f))
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,268 @@
+import argparse
+import json
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+from models.resnet import ASConv2d, ASBatchNorm2d, ASAct, ASLinear, multi_resnet18_kd
+from functions import compute_loss
+
+
+def zif(x: Tensor, gamma: float) -> Tensor:
+    """Heaviside spike with the rectangular surrogate gradient of ZIF, without an autograd.Function.
+    The window term is an exact zero in the forward and carries the 1/gamma gradient for |x| < gamma/2.
+    """
+    window = torch.where(x.abs() < gamma / 2, x / gamma, torch.zeros_like(x))
+    return (x >= 0).to(x.dtype) + (window - window.detach())
+
+
+def lif_seq(x_seq: Tensor, T: int, tau: float, thresh: float, gamma: float) -> Tensor:
+    # x_seq: [B*T, ...], the membrane is passed from timestep to timestep instead of living on the module
+    x = x_seq.float().view([-1, T] + list(x_seq.shape[1:]))
+    mem = torch.zeros_like(x[:, 0])
+    spikes: List[Tensor] = []
+    for t in range(T):
+        mem = mem * tau + x[:, t]
+        spike = zif(mem - thresh, gamma)
+        mem = (1 - spike) * mem
+        spikes.append(spike)
+    return torch.stack(spikes, 1).flatten(0, 1)
+
+
+class CaptureConv(nn.Module):
+    bias: Optional[Tensor]
+
+    def __init__(self, conv: ASConv2d):
+        super(CaptureConv, self).__init__()
+        self.U = conv.U
+        self.V = conv.V
+        self.sigma_ann = conv.sigma_ann
+        self.sigma_snn = conv.sigma_snn
+        self.bias = conv.bias
+        self.stride = conv.stride
+        self.padding = conv.padding
+
+    def forward(self, x: Tensor, use_ann: bool) -> Tensor:
+        sigma = self.sigma_ann if use_ann else self.sigma_snn
+        weight = (self.U @ (sigma.unsqueeze(-1) * self.V)).permute(2, 3, 0, 1)
+        return F.conv2d(x, weight, self.bias, self.stride, self.padding)
+
+
+class CaptureLinear(nn.Module):
+    bias: Optional[Tensor]
+
+    def __init__(self, linear: ASLinear):
+        super(CaptureLinear, self).__init__()
+        self.weight_ann = linear.weight_ann
+        self.weight_snn = linear.weight_snn
+        self.bias = linear.bias
+
+    def forward(self, x: Tensor, use_ann: bool) -> Tensor:
+        return F.linear(x, self.weight_ann if use_ann else self.weight_snn, self.bias)
+
+
+class CaptureAct(nn.Module):
+
+    def __init__(self, act: ASAct, T: int):
+        super(CaptureAct, self).__init__()
+        lif = act.act_snn
+        self.T = T
+        self.tau = lif.tau
+        self.thresh = lif.thresh
+        self.gamma = lif.gamma
+
+    def forward(self, x: Tensor, use_ann: bool) -> Tensor:
+        if use_ann:
+            return F.relu(x)
+        return lif_seq(x, self.T, self.tau, self.thresh, self.gamma)
+
+
+class CaptureUnit(nn.Module):
+    """ASConv2d -> ASBatchNorm2d -> optional ASAct with the mode as an argument, snn activations are multi-step."""
+
+    def __init__(self, conv: ASConv2d, bn: ASBatchNorm2d, act: Optional[ASAct], T: int):
+        super(CaptureUnit, self).__init__()
+        self.conv = CaptureConv(conv)
+        self.bn_ann = bn.bn_ann
+        self.bn_snn = bn.bn_snn
+        self.act = None if act is None else CaptureAct(act, T)
+
+    def forward(self, x: Tensor, use_ann: bool) -> Tensor:
+        x = self.conv(x, use_ann)
+        x = self.bn_ann(x) if use_ann else self.bn_snn(x)
+        act = self.act
+        if act is not None:
+            x = act(x, use_ann)
+        return x
+
+
+class CaptureBlock(nn.Module):
+
+    def __init__(self, block, T):
+        super(CaptureBlock, self).__init__()
+        self.unit1 = CaptureUnit(block.conv1, block.bn1, block.relu1, T)
+        self.unit2 = CaptureUnit(block.conv2, block.bn2, None, T)
+        self.downsample = None if block.downsample is None else \
+            CaptureUnit(block.downsample[0], block.downsample[1], None, T)
+        self.relu2 = CaptureAct(block.relu2, T)
+
+    def forward(self, x: Tensor, use_ann: bool) -> Tensor:
+        output = self.unit2(self.unit1(x, use_ann), use_ann)
+        downsample = self.downsample
+        residual = x if downsample is None else downsample(x, use_ann)
+        return self.relu2(output + residual, use_ann)
+
+
+class CaptureHead(nn.Module):
+
+    def __init__(self, bottleneck, fc, T):
+        super(CaptureHead, self).__init__()
+        self.units = nn.ModuleList([CaptureUnit(bottleneck[i], bottleneck[i + 1], bottleneck[i + 2], T)
+                                    for i in range(0, len(bottleneck), 3)])
+        self.fc = CaptureLinear(fc)
+
+    def forward(self, x: Tensor, use_ann: bool) -> Tuple[Tensor, Tensor]:
+        for unit in self.units:
+            x = unit(x, use_ann)
+        fea = F.adaptive_avg_pool2d(x, 1)
+        return self.fc(torch.flatten(fea, 1), use_ann), fea
+
+
+class CaptureResNet(nn.Module):
+    """Multi_ResNet without Python-level mutable state, for torch.jit.script and torch.compile.
+    The ann/snn mode is an argument instead of use_ann flags, the LIF membrane is a local of the multi-step loop
+    instead of LIFSpike.mem, and spikes come from zif instead of a per call autograd.Function.
+    Parameters and BatchNorm buffers are shared with the wrapped model, so training either trains both and
+    checkpoints keep the Multi_ResNet layout. The snn pass always runs multi-step, truncated convs compose their
+    smaller dense weight, the LIF reset is never detached, and SyncBatchNorm2d cannot be scripted.
+
+    Example:
+        >>> train_model = torch.compile(CaptureResNet(model))
+        >>> loss = compute_loss(train_model, images, labels)
+    """
+
+    def __init__(self, model):
+        super(CaptureResNet, self).__init__()
+        self.T = model.T
+        self.stem = CaptureUnit(model.conv1, model.bn1, model.relu, model.T)
+        self.layer1 = nn.ModuleList([CaptureBlock(b, model.T) for b in model.layer1])
+        self.layer2 = nn.ModuleList([CaptureBlock(b, model.T) for b in model.layer2])
+        self.layer3 = nn.ModuleList([CaptureBlock(b, model.T) for b in model.layer3])
+        self.layer4 = nn.ModuleList([CaptureBlock(b, model.T) for b in model.layer4])
+        self.head1 = CaptureHead(model.bottleneck1_1, model.middle_fc1, model.T)
+        self.head2 = CaptureHead(model.bottleneck2_1, model.middle_fc2, model.T)
+        self.head3 = CaptureHead(model.bottleneck3_1, model.middle_fc3, model.T)
+        self.fc = CaptureLinear(model.fc)
+
+    def one_time_forward(self, x: Tensor, use_ann: bool) -> List[Tensor]:
+        x = self.stem(x, use_ann)
+        for block in self.layer1:
+            x = block(x, use_ann)
+        middle_output1, middle1_fea = self.head1(x, use_ann)
+        for block in self.layer2:
+            x = block(x, use_ann)
+        middle_output2, middle2_fea = self.head2(x, use_ann)
+        for block in self.layer3:
+            x = block(x, use_ann)
+        middle_output3, middle3_fea = self.head3(x, use_ann)
+        for block in self.layer4:
+            x = block(x, use_ann)
+        final_fea = F.adaptive_avg_pool2d(x, 1)
+        x = self.fc(torch.flatten(final_fea, 1), use_ann)
+        return [x, middle_output1, middle_output2, middle_output3, final_fea, middle1_fea, middle2_fea, middle3_fea]
+
+    def snn_forward(self, x: Tensor) -> List[Tensor]:
+        B = x.shape[0]
+        x_seq = x.unsqueeze(1).repeat(1, self.T, 1, 1, 1).flatten(0, 1)
+        outputs = self.one_time_forward(x_seq, False)
+        return [out.view([B, self.T] + list(out.shape[1:])).sum(1) for out in outputs]
+
+    def forward(self, x: Tensor, snn_only: bool = False) -> Tuple[List[Tensor], List[Tensor]]:
+        """(ann outputs, snn outputs) as Multi_ResNet.forward, the ann list is empty with snn_only."""
+        if snn_only:
+            return [], self.snn_forward(x)
+        return self.one_time_forward(x, True), self.snn_forward(x)
+
+
+def capture_model(model, backend='inductor'):
+    """CaptureResNet of model, scripted ('script'), compiled with torch.compile (any other backend name) or eager
+    ('eager')."""
+    capture = CaptureResNet(model)
+    if backend == 'script':
+        return torch.jit.script(capture)
+    if backend == 'eager':
+        return capture
+    return torch.compile(capture, backend=backend)
+
+
+def time_steps(step, iters, warmup):
+    s_time = time.perf_counter()
+    step()
+    first = time.perf_counter() - s_time
+    for _ in range(warmup):
+        step()
+    times = []
+    for _ in range(iters):
+        s_time = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - s_time)
+    return first * 1000, float(np.percentile(np.array(times) * 1000, 50))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Eager vs TorchScript vs torch.compile Multi_ResNet on cpu')
+    parser.add_argument('--backends', default=['eager', 'script', 'inductor'], nargs='+',
+                        help='CaptureResNet variants compared with the eager multi-step Multi_ResNet')
+    parser.add_argument('-b', '--batch_size', default=8, type=int)
+    parser.add_argument('-T', '--time', default=4, type=int, help='snn simulation time')
+    parser.add_argument('--iters', default=5, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--out', default='bench_capture.json', type=str, help='json results file')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = multi_resnet18_kd(num_classes=10)
+    model.T = args.time
+    model.multi_step = True
+    model.train()
+    x = torch.randn(args.batch_size, 3, 32, 32)
+    y = torch.randint(10, (args.batch_size, ))
+
+    def cases(m, capture):
+        def train():
+            model.zero_grad(set_to_none=True)
+            compute_loss(m, x, y).backward()
+
+        def infer():
+            with torch.no_grad():
+                return m(x, True)[1][0] if capture else m(x, True)[0]
+        return {'train': train, 'snn_inference': infer}
+
+    # train mode bn normalizes with the batch statistics, so every variant sees the same outputs
+    with torch.no_grad():
+        reference = model(x)
+    results = []
+    variants = [('multi_resnet', model)] + [(backend, capture_model(model, backend)) for backend in args.backends]
+    for name, m in variants:
+        with torch.no_grad():
+            ann, snn = m(x)
+        # compiled kernels round differently, snn membranes sitting at the threshold may flip a spike
+        ann_diff = max((a - b).abs().max().item() for a, b in zip(ann, reference[0]))
+        agreement = snn[0].argmax(1).eq(reference[1][0].argmax(1)).float().mean().item()
+        for case, step in cases(m, m is not model).items():
+            first, p50 = time_steps(step, args.iters, args.warmup)
+            results.append({'variant': name, 'case': case, 'first_ms': first, 'p50_ms': p50,
+                            'ann_max_abs_diff': ann_diff, 'snn_prediction_agreement': agreement})
+    base = {r['case']: r['p50_ms'] for r in results if r['variant'] == 'multi_resnet'}
+    for r in results:
+        r['speedup'] = base[r['case']] / r['p50_ms']
+        print('{:<14s} {:<14s} first={:9.1f}ms p50={:8.1f}ms x{:.2f}  ann diff={:.1e} snn agreement={:.3f}'.format(
+            r['variant'], r['case'], r['first_ms'], r['p50_ms'], r['speedup'], r['ann_max_abs_diff'],
+            r['snn_prediction_agreement']))
+    with open(args.out, 'w') as f:
+        json.dump({'config': vars(args), 'torch': torch.__version__, 'results': results}, f, indent=2)
@@ -0,0 +1,119 @@
+// Fused multi-step LIF neuron for CPU.
+//
+// x is [B, T, N]. The forward pass runs the whole membrane recurrence
+//   h_t = tau * m_{t-1} + x_t,  s_t = H(h_t - thresh),  m_t = (1 - s_t) * h_t
+// in one sweep and saves either h (exact gradient through the reset) or, with
+// detach_reset, two bits per element (spike, surrogate window) packed four to
+// a byte. The backward pass runs the reverse recurrence in one sweep too.
+#include <torch/extension.h>
+#include <ATen/Parallel.h>
+
+#include <cmath>
+#include <vector>
+
+namespace {
+
+inline uint8_t get_flags(const uint8_t* packed, int64_t n) {
+  return (packed[n >> 2] >> ((n & 3) * 2)) & 3;
+}
+
+template <typename scalar_t>
+void forward_kernel(const scalar_t* x, scalar_t* spikes, scalar_t* mem_saved, uint8_t* flags_saved,
+                    int64_t B, int64_t T, int64_t N, scalar_t tau, scalar_t thresh, scalar_t half_gamma) {
+  const int64_t N4 = (N + 3) / 4;
+  at::parallel_for(0, B, 1, [&](int64_t b0, int64_t b1) {
+    std::vector<scalar_t> mem(N);
+    for (int64_t b = b0; b < b1; ++b) {
+      std::fill(mem.begin(), mem.end(), scalar_t(0));
+      for (int64_t t = 0; t < T; ++t) {
+        const int64_t off = (b * T + t) * N;
+        uint8_t* flags = flags_saved ? flags_saved + (b * T + t) * N4 : nullptr;
+        for (int64_t n = 0; n < N; ++n) {
+          const scalar_t h = mem[n] * tau + x[off + n];
+          const scalar_t v = h - thresh;
+          const bool spike = v >= scalar_t(0);
+          spikes[off + n] = spike ? scalar_t(1) : scalar_t(0);
+          mem[n] = spike ? scalar_t(0) : h;
+          if (flags) {
+            const uint8_t f = (spike ? 1 : 0) | (std::abs(v) < half_gamma ? 2 : 0);
+            flags[n >> 2] |= f << ((n & 3) * 2);
+          } else {
+            mem_saved[off + n] = h;
+          }
+        }
+      }
+    }
+  });
+}
+
+template <typename scalar_t>
+void backward_kernel(const scalar_t* grad_spikes, const scalar_t* mem_saved, const uint8_t* flags_saved,
+                     scalar_t* grad_x, int64_t B, int64_t T, int64_t N, scalar_t tau, scalar_t thresh,
+                     scalar_t half_gamma, scalar_t inv_gamma) {
+  const int64_t N4 = (N + 3) / 4;
+  at::parallel_for(0, B, 1, [&](int64_t b0, int64_t b1) {
+    std::vector<scalar_t> grad_mem(N);
+    for (int64_t b = b0; b < b1; ++b) {
+      std::fill(grad_mem.begin(), grad_mem.end(), scalar_t(0));
+      for (int64_t t = T - 1; t >= 0; --t) {
+        const int64_t off = (b * T + t) * N;
+        const uint8_t* flags = flags_saved ? flags_saved + (b * T + t) * N4 : nullptr;
+        for (int64_t n = 0; n < N; ++n) {
+          scalar_t grad_h;
+          if (flags) {
+            const uint8_t f = get_flags(flags, n);
+            const scalar_t sg = (f & 2) ? inv_gamma : scalar_t(0);
+            grad_h = grad_spikes[off + n] * sg + ((f & 1) ? scalar_t(0) : grad_mem[n]);
+          } else {
+            const scalar_t h = mem_saved[off + n];
+            const scalar_t v = h - thresh;
+            const scalar_t sg = std::abs(v) < half_gamma ? inv_gamma : scalar_t(0);
+            const bool spike = v >= scalar_t(0);
+            // m_t = (1 - s_t) * h_t, the spike in the reset is not detached
+            grad_h = (grad_spikes[off + n] - h * grad_mem[n]) * sg + (spike ? scalar_t(0) : grad_mem[n]);
+          }
+          grad_x[off + n] = grad_h;
+          grad_mem[n] = grad_h * tau;
+        }
+      }
+    }
+  });
+}
+
+}  // namespace
+
+std::vector<torch::Tensor> lif_forward(torch::Tensor x, double tau, double thresh, double gamma, bool detach_reset) {
+  TORCH_CHECK(x.device().is_cpu(), "lif_forward expects a CPU tensor");
+  TORCH_CHECK(x.dim() == 3, "lif_forward expects a [B, T, N] tensor");
+  x = x.contiguous();
+  const int64_t B = x.size(0), T = x.size(1), N = x.size(2);
+  auto spikes = torch::empty_like(x);
+  torch::Tensor saved = detach_reset ? torch::zeros({B, T, (N + 3) / 4}, x.options().dtype(torch::kUInt8))
+                                     : torch::empty_like(x);
+  AT_DISPATCH_FLOATING_TYPES(x.scalar_type(), "lif_forward", [&] {
+    forward_kernel<scalar_t>(x.data_ptr<scalar_t>(), spikes.data_ptr<scalar_t>(),
+                             detach_reset ? nullptr : saved.data_ptr<scalar_t>(),
+                             detach_reset ? saved.data_ptr<uint8_t>() : nullptr, B, T, N, scalar_t(tau),
+                             scalar_t(thresh), scalar_t(gamma / 2));
+  });
+  return {spikes, saved};
+}
+
+torch::Tensor lif_backward(torch::Tensor grad_spikes, torch::Tensor saved, double tau, double thresh, double gamma,
+                           bool detach_reset) {
+  grad_spikes = grad_spikes.contiguous();
+  const int64_t B = grad_spikes.size(0), T = grad_spikes.size(1), N = grad_spikes.size(2);
+  auto grad_x = torch::empty_like(grad_spikes);
+  AT_DISPATCH_FLOATING_TYPES(grad_spikes.scalar_type(), "lif_backward", [&] {
+    backward_kernel<scalar_t>(grad_spikes.data_ptr<scalar_t>(),
+                              detach_reset ? nullptr : saved.data_ptr<scalar_t>(),
+                              detach_reset ? saved.data_ptr<uint8_t>() : nullptr, grad_x.data_ptr<scalar_t>(), B,
+                              T, N, scalar_t(tau), scalar_t(thresh), scalar_t(gamma / 2), scalar_t(1.0 / gamma));
+  });
+  return grad_x;
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+  m.def("forward", &lif_forward, "fused multi-step LIF forward (CPU)");
+  m.def("backward", &lif_backward, "fused multi-step LIF backward (CPU)");
+}
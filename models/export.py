@@ -0,0 +1,162 @@
+import argparse
+import copy
+import os
+
+import torch
+import torch.nn as nn
+
+from models.resnet import ASConv2d, ASLinear, ASBatchNorm2d, ASAct, LIFSpike, multi_resnet18_kd, multi_resnet34_kd
+
+
+@torch.no_grad()
+def fold_conv_bn(conv, bn, use_ann):
+    """Plain nn.Conv2d with the composed U·diag(sigma)·V weight and the eval-mode BatchNorm folded in."""
+    weight = conv.compose(conv.sigma_ann if use_ann else conv.sigma_snn).detach()
+    bn = bn.bn_ann if use_ann else bn.bn_snn
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = bn.bias - bn.running_mean * scale
+    if conv.bias is not None:
+        bias = bias + conv.bias * scale
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, kernel_size=conv.kernel_size, stride=conv.stride,
+                      padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True)
+    fused.weight.copy_(weight * scale.view(-1, 1, 1, 1))
+    fused.bias.copy_(bias)
+    return fused.to(weight.device)
+
+
+@torch.no_grad()
+def convert_module(module, use_ann):
+    """Replace the AS* layers below module (in place) by plain layers of one mode."""
+    children = list(module.named_children())
+    for i, (name, child) in enumerate(children):
+        if isinstance(child, ASConv2d):
+            # the matching bn is conv1 -> bn1 in blocks and the stem, the next layer in nn.Sequential
+            bn_name = name.replace('conv', 'bn')
+            if not isinstance(getattr(module, bn_name, None), ASBatchNorm2d):
+                bn_name = children[i + 1][0]
+            setattr(module, name, fold_conv_bn(child, getattr(module, bn_name), use_ann))
+            setattr(module, bn_name, nn.Identity())
+        elif isinstance(child, ASLinear):
+            linear = nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+            linear.weight.copy_(child.weight_ann if use_ann else child.weight_snn)
+            if child.bias is not None:
+                linear.bias.copy_(child.bias)
+            setattr(module, name, linear.to(child.weight_snn.device))
+        elif isinstance(child, ASAct):
+            lif = child.act_snn
+            setattr(module, name, nn.ReLU(True) if use_ann else LIFSpike(lif.thresh, lif.tau, lif.gamma))
+        elif not isinstance(child, ASBatchNorm2d):
+            convert_module(child, use_ann)
+
+
+class InferenceResNet(nn.Module):
+    """Single-mode Multi_ResNet for deployment: plain convs with BN folded in, no ANN/SNN branches.
+    Args:
+        model (Multi_ResNet): trained model, left unchanged
+        mode (str): 'snn' or 'ann'
+        keep_heads (bool): keep the three middle classifiers
+    """
+
+    def __init__(self, model, mode='snn', keep_heads=False):
+        super(InferenceResNet, self).__init__()
+        self.snn = mode == 'snn'
+        self.T = model.T
+        self.multi_step = model.multi_step
+        self.keep_heads = keep_heads
+        names = ['conv1', 'bn1', 'relu', 'layer1', 'layer2', 'layer3', 'layer4', 'avgpool', 'fc']
+        if keep_heads:
+            names += ['bottleneck1_1', 'middle_fc1', 'bottleneck2_1', 'middle_fc2', 'bottleneck3_1', 'middle_fc3']
+        # do not copy the membranes left by the last forward of model
+        model.reset_neurons()
+        for name in names:
+            setattr(self, name, copy.deepcopy(getattr(model, name)))
+        convert_module(self, use_ann=not self.snn)
+        self.lif_neurons = [m for m in self.modules() if isinstance(m, LIFSpike)]
+        self.reset_neurons()
+
+    def reset_neurons(self):
+        for m in self.lif_neurons:
+            m.mem = 0
+            m.step_mode = 'm' if self.multi_step else 's'
+            m.T = self.T
+
+    def head(self, x, bottleneck, fc):
+        return fc(torch.flatten(self.avgpool(bottleneck(x)), 1))
+
+    def one_time_forward(self, x):
+        x = self.relu(self.bn1(self.conv1(x)))
+        x = self.layer1(x)
+        outputs = [self.head(x, self.bottleneck1_1, self.middle_fc1)] if self.keep_heads else []
+        x = self.layer2(x)
+        if self.keep_heads:
+            outputs.append(self.head(x, self.bottleneck2_1, self.middle_fc2))
+        x = self.layer3(x)
+        if self.keep_heads:
+            outputs.append(self.head(x, self.bottleneck3_1, self.middle_fc3))
+        x = self.layer4(x)
+        x = self.fc(torch.flatten(self.avgpool(x), 1))
+        return [x] + outputs
+
+    def forward(self, x):
+        """Final logits (summed over T for the snn), followed by the middle head logits if kept."""
+        if self.snn:
+            self.reset_neurons()
+            if self.multi_step:
+                B = x.shape[0]
+                outputs = self.one_time_forward(x.unsqueeze(1).repeat(1, self.T, 1, 1, 1).flatten(0, 1))
+                outputs = [out.view(B, self.T, -1).sum(1) for out in outputs]
+            else:
+                all_outputs = [self.one_time_forward(x) for _ in range(self.T)]
+                outputs = [sum(outs) for outs in zip(*all_outputs)]
+        else:
+            outputs = self.one_time_forward(x)
+        return tuple(outputs) if self.keep_heads else outputs[0]
+
+
+@torch.no_grad()
+def export_inference_model(model, mode='snn', keep_heads=False):
+    model.eval()
+    return InferenceResNet(model, mode, keep_heads).eval()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export an inference-only model from a Multi_ResNet checkpoint')
+    parser.add_argument('--checkpoint', default='res18.pth', type=str, help='Multi_ResNet state dict')
+    parser.add_argument('--out', default='res18_snn.pth', type=str, help='exported model file')
+    parser.add_argument('--arch', default='resnet18', choices=['resnet18', 'resnet34'])
+    parser.add_argument('--num_classes', default=10, type=int)
+    parser.add_argument('--mode', default='snn', choices=['snn', 'ann'])
+    parser.add_argument('-T', '--time', default=4, type=int, help='snn simulation time')
+    parser.add_argument('--keep_heads', action='store_true', help='keep the middle classifiers')
+    args = parser.parse_args()
+
+    # pickle the exported class as models.export.InferenceResNet, not __main__.InferenceResNet
+    from models.export import export_inference_model
+
+    build = multi_resnet18_kd if args.arch == 'resnet18' else multi_resnet34_kd
+    model = build(num_classes=args.num_classes)
+    model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    model.T = args.time
+    exported = export_inference_model(model, args.mode, args.keep_heads)
+
+    x = torch.randn(8, 3, 32, 32)
+    with torch.no_grad():
+        if args.mode == 'snn':
+            reference = model(x, True)[0]
+        else:
+            model.use_ann_mode_tag(True)
+            model.reset_neurons()
+            reference = model.one_time_forward(x)[0]
+        output = exported(x)
+        output = output[0] if args.keep_heads else output
+    # folding BN changes rounding, so snn spikes sitting exactly at the threshold may flip
+    print('max abs logit difference: {:.3e}, prediction agreement: {:.3f}'.format(
+        (output - reference).abs().max().item(), output.argmax(1).eq(reference.argmax(1)).float().mean().item()))
+
+    # keep the batch-sized membranes of the check forward out of the file
+    exported.reset_neurons()
+    torch.save(exported, args.out)
+    print('parameters: {} -> {}'.format(sum(p.numel() for p in model.parameters()),
+                                        sum(p.numel() for p in exported.parameters())))
+    print('file size: {:.1f}MB -> {:.1f}MB'.format(os.path.getsize(args.checkpoint) / 2 ** 20,
+                                                   os.path.getsize(args.out) / 2 ** 20))
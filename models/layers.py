@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 from IPython import embed
+from models.lif import lif_multistep
+from models.spike_storage import mark_spike
 
 class SeqToANNContainer(nn.Module):
     def __init__(self, *args):
@@ -64,13 +66,17 @@ def mem_update(x_in, mem, V_th, decay, gamma=1.0):
     return mem, spike
 
 class LIFSpike(nn.Module):
-    def __init__(self, thresh=0.5, tau=0.25, gamma=1.0):
+    def __init__(self, thresh=0.5, tau=0.25, gamma=1.0, fused=False):
         super(LIFSpike, self).__init__()
         self.thresh = thresh
         self.tau = tau
         self.gamma = gamma
+        self.fused = fused
 
     def forward(self, x):
+        if self.fused:
+            return mark_spike(lif_multistep(x, self.tau, self.thresh, self.gamma))
+        x = x.float()
         mem = torch.zeros_like(x[:, 0])
         #embed()
         spikes = []
@@ -81,7 +87,7 @@ class LIFSpike(nn.Module):
             #mem = (1 - spike) * mem
             mem, spike = mem_update(x_in=x[:, t, ...], mem=mem, V_th=self.thresh, decay=self.tau, gamma=self.gamma)
             spikes.append(spike)
-        return torch.stack(spikes, dim=1)
+        return mark_spike(torch.stack(spikes, dim=1))
 
 
 def add_dimention(x, T):
@@ -0,0 +1,131 @@
+import os
+import warnings
+from typing import Tuple
+
+import torch
+from torch import Tensor
+
+
+# the reference kernels below are plain eager code that torch.jit.script and torch.compile accept as is
+
+_extension = None
+_extension_failed = False
+
+
+def load_extension(verbose=False):
+    """JIT-build the C++ LIF kernel in models/csrc, None if it cannot be built."""
+    global _extension, _extension_failed
+    if _extension is None and not _extension_failed:
+        try:
+            from torch.utils.cpp_extension import load
+            source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'csrc', 'lif.cpp')
+            _extension = load(name='lif_cpp', sources=[source],
+                              extra_cflags=['-O3', '-ffp-contract=off'], verbose=verbose)
+        except Exception as e:
+            _extension_failed = True
+            # the scripted fallback keeps the memory saving but runs about as fast as the unfused LIF loop
+            warnings.warn('LIF C++ extension unavailable, using the TorchScript reference kernel: {}'.format(e))
+    return _extension
+
+
+def pack_flags(spike: Tensor, window: Tensor) -> Tensor:
+    # two bits per element (spike, surrogate window), four elements per byte along the last dim
+    B, T, N = spike.shape
+    flags = spike.to(torch.uint8) | (window.to(torch.uint8) << 1)
+    flags = torch.nn.functional.pad(flags, [0, (4 - N % 4) % 4]).view(B, T, -1, 4)
+    return (flags[..., 0] | (flags[..., 1] << 2) | (flags[..., 2] << 4) | (flags[..., 3] << 6)).contiguous()
+
+
+def unpack_flags(packed: Tensor, N: int) -> Tensor:
+    shifts = torch.arange(0, 8, 2, dtype=torch.uint8, device=packed.device)
+    flags = (packed.unsqueeze(-1) >> shifts) & 3
+    return flags.flatten(-2)[..., :N]
+
+
+def lif_forward_ref(x: Tensor, tau: float, thresh: float, gamma: float,
+                    detach_reset: bool) -> Tuple[Tensor, Tensor]:
+    # x: [B, T, N], same recurrence and rounding as LIFSpike.seq_forward
+    mem = torch.zeros_like(x[:, 0])
+    spikes = torch.empty_like(x)
+    hs = torch.empty_like(x)
+    for t in range(x.shape[1]):
+        h = mem * tau + x[:, t]
+        spike = (h - thresh >= 0).to(x.dtype)
+        mem = (1 - spike) * h
+        spikes[:, t] = spike
+        hs[:, t] = h
+    if detach_reset:
+        return spikes, pack_flags(spikes, (hs - thresh).abs() < gamma / 2)
+    return spikes, hs
+
+
+def lif_backward_ref(grad_spikes: Tensor, saved: Tensor, tau: float, thresh: float, gamma: float,
+                     detach_reset: bool) -> Tensor:
+    grad_x = torch.empty_like(grad_spikes)
+    grad_mem = torch.zeros_like(grad_spikes[:, 0])
+    if detach_reset:
+        flags = unpack_flags(saved, grad_spikes.shape[2])
+        not_spike = ((flags & 1) == 0).to(grad_spikes.dtype)
+        sg = ((flags & 2) != 0).to(grad_spikes.dtype) / gamma
+        for t in range(grad_spikes.shape[1] - 1, -1, -1):
+            grad_h = grad_spikes[:, t] * sg[:, t] + grad_mem * not_spike[:, t]
+            grad_x[:, t] = grad_h
+            grad_mem = grad_h * tau
+    else:
+        for t in range(grad_spikes.shape[1] - 1, -1, -1):
+            h = saved[:, t]
+            sg = ((h - thresh).abs() < gamma / 2).to(h.dtype) / gamma
+            not_spike = (h - thresh < 0).to(h.dtype)
+            grad_h = (grad_spikes[:, t] - h * grad_mem) * sg + grad_mem * not_spike
+            grad_x[:, t] = grad_h
+            grad_mem = grad_h * tau
+    return grad_x
+
+
+# the fallback when the C++ extension cannot be built, scripted once so the time loops run in the TorchScript
+# interpreter instead of Python
+with warnings.catch_warnings():
+    # torch.jit.script is deprecated in recent releases but still the cheapest way to run these loops
+    warnings.simplefilter('ignore', FutureWarning)
+    lif_forward_script = torch.jit.script(lif_forward_ref)
+    lif_backward_script = torch.jit.script(lif_backward_ref)
+
+
+class FusedLIF(torch.autograd.Function):
+    """Multi-step LIF over a [B, T, N] tensor with a single-pass custom backward.
+
+    Only the pre-reset membrane is saved (or, with detach_reset, 2-bit packed
+    spike/window flags), instead of the per-timestep tensors autograd keeps
+    for the unfused loop.
+    """
+
+    @staticmethod
+    def forward(ctx, x, tau, thresh, gamma, detach_reset, use_extension):
+        ext = load_extension() if use_extension and x.device.type == 'cpu' else None
+        if ext is not None:
+            spikes, saved = ext.forward(x, tau, thresh, gamma, detach_reset)
+        else:
+            spikes, saved = lif_forward_script(x, tau, thresh, gamma, detach_reset)
+        ctx.save_for_backward(saved)
+        ctx.params = (tau, thresh, gamma, detach_reset)
+        ctx.use_extension = ext is not None
+        return spikes
+
+    @staticmethod
+    def backward(ctx, grad_spikes):
+        (saved, ) = ctx.saved_tensors
+        if ctx.use_extension:
+            grad_x = load_extension().backward(grad_spikes, saved, *ctx.params)
+        else:
+            grad_x = lif_backward_script(grad_spikes.contiguous(), saved, *ctx.params)
+        return grad_x, None, None, None, None, None
+
+
+def lif_multistep(x_seq, tau=0.25, thresh=0.5, gamma=1.0, detach_reset=False, backend='auto'):
+    """Spikes for x_seq [B, T, ...]; backend is 'auto' (C++ on CPU if it builds), 'cpp' or 'script'."""
+    B, T = x_seq.shape[:2]
+    x = x_seq.float().reshape(B, T, -1)
+    if backend == 'cpp' and load_extension() is None:
+        raise RuntimeError('LIF C++ extension could not be built')
+    spikes = FusedLIF.apply(x, tau, thresh, gamma, detach_reset, backend != 'script')
+    return spikes.view(x_seq.shape)
@@ -0,0 +1,154 @@
+import contextlib
+import json
+import time
+from collections import defaultdict
+
+import torch
+
+
+class StepProfiler(object):
+    """Wall time and memory of every named module of a Multi_ResNet, split by ann/snn mode and timestep.
+    Forward times come from module pre/post hooks. Backward times run from the arrival of the gradient of a call's
+    output to the arrival of the gradient of its input (tensor hooks, so in-place ReLU and residual adds still work).
+    Times are inclusive, a block contains its convs. Memory is the allocator delta on cuda, and the bytes of the
+    module output otherwise.
+
+    Example:
+        >>> with StepProfiler(model) as profiler:
+        >>>     with profiler.region('compute_loss'):
+        >>>         loss = compute_loss(model, images, labels)
+        >>> profiler.save_trace('trace.json')
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.handles = []
+        self.events = []
+        self.stack = {}
+        self.timestep = -1
+        self.origin = None
+        self.cuda = False
+
+    def __enter__(self):
+        self.origin = time.perf_counter()
+        self.cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+        for name, m in self.model.named_modules():
+            name = name or 'model'
+            self.handles.append(m.register_forward_pre_hook(self._pre_hook(name)))
+            self.handles.append(m.register_forward_hook(self._post_hook(name)))
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _now(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def _memory(self):
+        return torch.cuda.memory_allocated() if self.cuda else 0
+
+    def _context(self, m):
+        if self.model.use_ann is None:
+            # fused joint batch
+            return 'joint', 'all'
+        mode = 'ann' if self.model.use_ann else 'snn'
+        if mode == 'ann':
+            return mode, 0
+        # the whole model and multi-step modules span every timestep
+        return mode, 'all' if m is self.model or self.model.multi_step else self.timestep
+
+    def _pre_hook(self, name):
+        def hook(m, inputs):
+            if m is self.model:
+                self.timestep = -1
+            elif m is self.model.conv1 and not self.model.use_ann:
+                # every snn timestep starts at conv1
+                self.timestep += 1
+            self.stack.setdefault(name, []).append((self._now(), self._memory()))
+        return hook
+
+    def _post_hook(self, name):
+        def hook(m, inputs, output):
+            start, memory = self.stack[name].pop()
+            end = self._now()
+            mode, t = self._context(m)
+            outputs = output if isinstance(output, (list, tuple)) else [output]
+            tensors = [o for o in outputs if isinstance(o, torch.Tensor)]
+            if self.cuda:
+                memory = self._memory() - memory
+            else:
+                memory = sum(o.numel() * o.element_size() for o in tensors)
+            self.events.append({'name': name, 'pass': 'forward', 'mode': mode, 'timestep': t, 'ts': start,
+                                'dur': end - start, 'memory': memory})
+            if torch.is_grad_enabled():
+                self._watch_backward(name, mode, t, inputs, tensors)
+        return hook
+
+    def _watch_backward(self, name, mode, t, inputs, outputs):
+        inputs = [x for x in inputs if isinstance(x, torch.Tensor) and x.requires_grad]
+        outputs = [o for o in outputs if o.requires_grad]
+        if not inputs or not outputs:
+            return
+        state = {}
+
+        def output_grad(grad):
+            state.setdefault('start', self._now())
+
+        def input_grad(grad):
+            if 'start' in state and 'end' not in state:
+                state['end'] = self._now()
+                self.events.append({'name': name, 'pass': 'backward', 'mode': mode, 'timestep': t,
+                                    'ts': state['start'], 'dur': state['end'] - state['start'], 'memory': 0})
+
+        for o in outputs:
+            o.register_hook(output_grad)
+        for x in inputs:
+            x.register_hook(input_grad)
+
+    @contextlib.contextmanager
+    def region(self, name):
+        """Time a block of the training step (loss, backward, optimizer) next to the module events."""
+        start = self._now()
+        memory = self._memory()
+        yield
+        self.events.append({'name': name, 'pass': 'step', 'mode': '', 'timestep': 0, 'ts': start,
+                            'dur': self._now() - start, 'memory': self._memory() - memory})
+
+    def table(self):
+        """Events aggregated over calls per (module, pass, mode, timestep), slowest first."""
+        groups = defaultdict(lambda: {'calls': 0, 'total_ms': 0., 'memory': 0})
+        for e in self.events:
+            g = groups[(e['name'], e['pass'], e['mode'], str(e['timestep']))]
+            g['calls'] += 1
+            g['total_ms'] += e['dur'] / 1000
+            g['memory'] = max(g['memory'], e['memory'])
+        rows = [{'name': k[0], 'pass': k[1], 'mode': k[2], 'timestep': k[3], 'calls': g['calls'],
+                 'total_ms': g['total_ms'], 'mean_ms': g['total_ms'] / g['calls'], 'max_memory': g['memory']}
+                for k, g in groups.items()]
+        return sorted(rows, key=lambda r: -r['total_ms'])
+
+    def format_table(self, top=40):
+        lines = ['{:<32s} {:<8s} {:<5s} {:>4s} {:>6s} {:>10s} {:>10s} {:>12s}'.format(
+            'module', 'pass', 'mode', 't', 'calls', 'total ms', 'mean ms', 'memory')]
+        for r in self.table()[:top]:
+            lines.append('{:<32s} {:<8s} {:<5s} {:>4s} {:>6d} {:>10.2f} {:>10.3f} {:>12d}'.format(
+                r['name'][:32], r['pass'], r['mode'], r['timestep'], r['calls'], r['total_ms'], r['mean_ms'],
+                r['max_memory']))
+        return '\n'.join(lines)
+
+    def save_table(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.table(), f, indent=2)
+
+    def save_trace(self, path):
+        """Chrome trace (chrome://tracing, Perfetto) with one row per pass."""
+        tids = {'step': 0, 'forward': 1, 'backward': 2}
+        trace = [{'name': e['name'], 'ph': 'X', 'ts': e['ts'], 'dur': e['dur'], 'pid': 0, 'tid': tids[e['pass']],
+                  'args': {'mode': e['mode'], 'timestep': e['timestep'], 'memory': e['memory']}}
+                 for e in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace}, f)
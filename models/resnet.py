@@ -1,26 +1,39 @@
 import random
 import torch.linalg
 import torch.nn as nn
+import torch.distributed as dist
 from torch.nn import functional as F
+from models.lif import lif_multistep
+from models.spike_storage import mark_spike
+
+
+class ZIF(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, input, gamma):
+        out = (input >= 0).float()
+        ctx.save_for_backward(input)
+        ctx.gamma = gamma
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        (input, ) = ctx.saved_tensors
+        gamma = ctx.gamma
+        grad_input = grad_output.clone()
+        tmp = (input.abs() < gamma/2).float() / gamma
+        grad_input = grad_input * tmp
+        return grad_input, None
 
 
 def fire_function(gamma):
-    class ZIF(torch.autograd.Function):
-        @staticmethod
-        def forward(ctx, input):
-            out = (input >= 0).float()
-            ctx.save_for_backward(input)
-            return out
+    return lambda input: ZIF.apply(input, gamma)
 
-        @staticmethod
-        def backward(ctx, grad_output):
-            (input, ) = ctx.saved_tensors
-            grad_input = grad_output.clone()
-            tmp = (input.abs() < gamma/2).float() / gamma
-            grad_input = grad_input * tmp
-            return grad_input, None
 
-    return ZIF.apply
+def joint_apply(x, n, ann_fn, snn_fn):
+    # fused joint batch: the first n samples take the ann path, the rest the snn path.
+    # split backpropagates as one cat, two slices would each scatter into a zero filled full size gradient
+    ann, snn = x.split([n, x.shape[0] - n])
+    return torch.cat([ann_fn(ann), snn_fn(snn)])
 
 
 class LIFSpike(nn.Module):
@@ -30,12 +43,37 @@ class LIFSpike(nn.Module):
         self.tau = tau
         self.gamma = gamma
         self.mem = 0
+        # 's': one timestep per call, 'm': input is [B*T, ...] holding all T timesteps
+        self.step_mode = 's'
+        self.T = 1
+        # multi-step only: run the whole recurrence in the fused LIF kernel
+        self.fused = False
+        # no gradient through the reset, the fused kernel then saves 2-bit spike/window flags instead of h
+        self.detach_reset = False
 
     def forward(self, x):
-        self.mem = self.mem * self.tau + x
-        spike = fire_function(self.gamma)(self.mem - self.thresh)
-        self.mem = (1 - spike) * self.mem
-        return spike
+        if self.step_mode == 'm':
+            x_seq = x.view(-1, self.T, *x.shape[1:])
+            return mark_spike(self.seq_forward(x_seq).flatten(0, 1))
+        # the membrane stays float32 under autocast so the threshold is not applied to rounded potentials
+        self.mem = self.mem * self.tau + x.float()
+        spike = ZIF.apply(self.mem - self.thresh, self.gamma)
+        self.mem = (1 - (spike.detach() if self.detach_reset else spike)) * self.mem
+        return mark_spike(spike)
+
+    def seq_forward(self, x_seq):
+        # x_seq: [B, T, ...], only the membrane recurrence loops over time
+        if self.fused:
+            return lif_multistep(x_seq, self.tau, self.thresh, self.gamma, self.detach_reset)
+        mem = 0
+        spikes = []
+        for t in range(x_seq.shape[1]):
+            mem = mem * self.tau + x_seq[:, t].float()
+            spike = ZIF.apply(mem - self.thresh, self.gamma)
+            mem = (1 - (spike.detach() if self.detach_reset else spike)) * mem
+            spikes.append(spike)
+        self.mem = mem
+        return torch.stack(spikes, dim=1)
 
 
 class ASConv2d(nn.Conv2d):
@@ -44,6 +82,14 @@ class ASConv2d(nn.Conv2d):
         super(ASConv2d, self).__init__(in_planes, out_planes, kernel_size=kernel_size, stride=stride, padding=padding,
                                        groups=1, bias=bias, dilation=1)
         self.use_ann = True
+        # composed U·diag(sigma)·V per mode, keyed on the parameter versions
+        self._weight_cache = {}
+        # set by Multi_ResNet.forward while it runs, scopes the reuse of weights composed with grad
+        self.forward_step = None
+        # set by truncate: run low rank layers as two cheaper convs instead of composing the full weight
+        self.factorized = False
+        # > 0 in the fused joint forward: number of leading ann samples in the batch
+        self.joint_split = 0
 
     def initialize(self):
         # initialize the U, V, sigma_a/snn based on the weight
@@ -54,14 +100,139 @@ class ASConv2d(nn.Conv2d):
         self.register_parameter('V', nn.Parameter(Vh))
         self.register_parameter('sigma_ann', nn.Parameter(sigma))
         self.register_parameter('sigma_snn', nn.Parameter(sigma.clone()))
+        delattr(self, 'weight')
+
+    def __getstate__(self):
+        # cached weights may carry an autograd graph, never copy or pickle them
+        state = self.__dict__.copy()
+        state['_weight_cache'] = {}
+        return state
+
+    def clear_weight_cache(self):
+        self._weight_cache = {}
+
+    def _cache_key(self, use_ann, device_type):
+        sigma = self.sigma_ann if use_ann else self.sigma_snn
+        # a weight composed with grad carries its graph, which the first backward frees: only reuse it within
+        # the Multi_ResNet.forward that built it
+        step = self.forward_step if torch.is_grad_enabled() else None
+        return (self.U.data_ptr(), self.U._version, self.V._version, sigma._version,
+                step, torch.is_autocast_enabled(device_type), self.factorized)
+
+    def composed_weight(self, use_ann, device_type='cpu'):
+        # recomposed only when U, V or sigma change (optimizer step, load_state_dict, .to());
+        # reused across the T snn timesteps of a step and across batches at inference
+        if torch.is_grad_enabled() and self.forward_step is None:
+            return self.compose(self.sigma_ann if use_ann else self.sigma_snn, self.factorized)
+        key = self._cache_key(use_ann, device_type)
+        cached = self._weight_cache.get(use_ann)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        other = self._weight_cache.get(not use_ann)
+        if self.training and (other is None or other[0] != self._cache_key(not use_ann, device_type)):
+            # joint training runs both modes on the same U, V within a step: compose both weights together.
+            # Two row scaled products beat one broadcast batched product on cpu, which copies U per mode
+            for mode, sigma in ((True, self.sigma_ann), (False, self.sigma_snn)):
+                self._weight_cache[mode] = (self._cache_key(mode, device_type), self.compose(sigma, self.factorized))
+            return self._weight_cache[use_ann][1]
+        weight = self.compose(self.sigma_ann if use_ann else self.sigma_snn, self.factorized)
+        self._weight_cache[use_ann] = (key, weight)
+        return weight
+
+    def compose(self, sigma, factorized=False):
+        """U·diag(sigma)·V, scaling the rows of V instead of building a diagonal matrix per tap.
+        factorized returns the (V, U·diag(sigma)) 1x1 conv weights of factorized_forward instead.
+        """
+        k, _, c_o, r = self.U.shape
+        if factorized:
+            # two 1x1 convs: V for every tap, then U·diag(sigma) over the shifted tap outputs
+            return (self.V.reshape(k * k * r, self.in_channels, 1, 1),
+                    (self.U * sigma.unsqueeze(-2)).permute(2, 0, 1, 3).reshape(c_o, k * k * r, 1, 1))
+        return (self.U @ (sigma.unsqueeze(-1) * self.V)).permute([2, 3, 0, 1])
+
+    @property
+    def rank(self):
+        return self.sigma_ann.shape[-1]
+
+    def truncate(self, rank=None, energy=None):
+        """Keep the `rank` strongest singular triplets of every kernel tap, or as few as hold `energy` of the
+        squared spectrum on every tap. Strength is |sigma_ann|²+|sigma_snn|² scaled by the U column and V row norms,
+        which training moves away from 1. Returns the kept rank.
+        """
+        with torch.no_grad():
+            strength = (self.sigma_ann ** 2 + self.sigma_snn ** 2) * \
+                self.U.norm(dim=-2) ** 2 * self.V.norm(dim=-1) ** 2
+            strength, order = strength.sort(dim=-1, descending=True)
+            if energy is not None:
+                kept = strength.cumsum(-1) / strength.sum(-1, keepdim=True).clamp(min=1e-12)
+                rank = int((kept < energy).sum(-1).max()) + 1
+            rank = min(rank or self.rank, self.rank)
+            if rank < self.rank:
+                index = order[..., :rank]
+                k, _, c_o, _ = self.U.shape
+                self._set_factors(self.U.gather(-1, index.unsqueeze(-2).expand(k, k, c_o, rank)),
+                                  self.sigma_ann.gather(-1, index), self.sigma_snn.gather(-1, index),
+                                  self.V.gather(-2, index.unsqueeze(-1).expand(k, k, rank, self.in_channels)))
+        return rank
+
+    def _set_factors(self, U, sigma_ann, sigma_snn, V):
+        self.U = nn.Parameter(U.contiguous())
+        self.sigma_ann = nn.Parameter(sigma_ann.contiguous())
+        self.sigma_snn = nn.Parameter(sigma_snn.contiguous())
+        self.V = nn.Parameter(V.contiguous())
+        # the two conv form pays off on cpu at stride 1 once it needs at most a quarter of the dense conv's MACs,
+        # the shifted tap copies eat the rest
+        self.factorized = self.stride == (1, 1) and \
+            self.rank * (self.in_channels + self.out_channels) * 4 <= self.in_channels * self.out_channels
+        self.clear_weight_cache()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the seed weight was dropped still hold it
+        state_dict.pop(prefix + 'weight', None)
+        # checkpoints of truncated layers load into full rank models and vice versa
+        U = state_dict.get(prefix + 'U')
+        if U is not None and hasattr(self, 'U') and U.shape != self.U.shape:
+            empty = lambda key: torch.empty_like(state_dict[prefix + key], device=self.U.device)
+            self._set_factors(empty('U'), empty('sigma_ann'), empty('sigma_snn'), empty('V'))
+        super(ASConv2d, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def macs(self, output):
+        """Multiply-accumulates of the forward that produced output."""
+        if self.factorized:
+            k = self.kernel_size[0]
+            return output.numel() // self.out_channels * k * k * self.rank * (self.in_channels + self.out_channels)
+        return output.numel() * self.in_channels // self.groups * self.kernel_size[0] * self.kernel_size[1]
+
+    def factorized_taps(self, x, V):
+        # the V conv and the shifted tap outputs, shared by ann and snn
+        k, r, p, s = self.kernel_size[0], self.rank, self.padding[0], self.stride[0]
+        h_out = (x.shape[2] + 2 * p - k) // s + 1
+        w_out = (x.shape[3] + 2 * p - k) // s + 1
+        z = F.conv2d(x, V)
+        if p:
+            z = F.pad(z, [p] * 4)
+        taps = [z[:, t * r:(t + 1) * r, t // k:t // k + s * (h_out - 1) + 1:s, t % k:t % k + s * (w_out - 1) + 1:s]
+                for t in range(k * k)]
+        return torch.cat(taps, 1) if len(taps) > 1 else taps[0]
 
     def forward(self, x):
-        if self.use_ann is True:
-            weight_ann = (self.U @ torch.diag_embed(self.sigma_ann) @ self.V).permute([2, 3, 0, 1])
-            return self._conv_forward(x, weight_ann, self.bias)
-        else:
-            weight_snn = (self.U @ torch.diag_embed(self.sigma_snn) @ self.V).permute([2, 3, 0, 1])
-            return self._conv_forward(x, weight_snn, self.bias)
+        if self.joint_split:
+            return self.joint_forward(x)
+        weight = self.composed_weight(self.use_ann is True, x.device.type)
+        if self.factorized:
+            return F.conv2d(self.factorized_taps(x, weight[0]), weight[1], self.bias)
+        return self._conv_forward(x, weight, self.bias)
+
+    def joint_forward(self, x):
+        ann = self.composed_weight(True, x.device.type)
+        snn = self.composed_weight(False, x.device.type)
+        if self.factorized:
+            # U and V are shared, only the sigma scaled 1x1 conv differs between the slices
+            taps = self.factorized_taps(x, ann[0])
+            return joint_apply(taps, self.joint_split, lambda t: F.conv2d(t, ann[1], self.bias),
+                               lambda t: F.conv2d(t, snn[1], self.bias))
+        return joint_apply(x, self.joint_split, lambda x: self._conv_forward(x, ann, self.bias),
+                           lambda x: self._conv_forward(x, snn, self.bias))
 
 
 class ASLinear(nn.Linear):
@@ -69,6 +240,7 @@ class ASLinear(nn.Linear):
     def __init__(self, *args):
         super(ASLinear, self).__init__(*args)
         self.use_ann = True
+        self.joint_split = 0
 
     def initialize(self):
         org_weight = self.weight.data
@@ -77,6 +249,9 @@ class ASLinear(nn.Linear):
         delattr(self, 'weight')
 
     def forward(self, x):
+        if self.joint_split:
+            return joint_apply(x, self.joint_split, lambda x: F.linear(x, self.weight_ann, self.bias),
+                               lambda x: F.linear(x, self.weight_snn, self.bias))
         if self.use_ann is True:
             return F.linear(x, self.weight_ann, self.bias)
         else:
@@ -87,24 +262,85 @@ class ASBatchNorm2d(nn.Module):
     def __init__(self, n_channel):
         super(ASBatchNorm2d, self).__init__()
         self.use_ann = True
+        self.joint_split = 0
         self.bn_ann = nn.BatchNorm2d(n_channel)
         self.bn_snn = nn.BatchNorm2d(n_channel)
 
     def forward(self, x):
+        if self.joint_split:
+            return joint_apply(x, self.joint_split, self.bn_ann, self.bn_snn)
         if self.use_ann:
             return self.bn_ann(x)
         else:
             return self.bn_snn(x)
 
 
+class AllReduceSum(torch.autograd.Function):
+    # the gradient of a sum over ranks is the sum of the gradients over ranks
+    @staticmethod
+    def forward(ctx, x):
+        x = x.clone()
+        dist.all_reduce(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.clone()
+        dist.all_reduce(grad_output)
+        return grad_output
+
+
+class SyncBatchNorm2d(nn.BatchNorm2d):
+    """BatchNorm2d whose training statistics are all-reduced over the process group.
+    Unlike nn.SyncBatchNorm it also runs on cpu tensors (gloo backend).
+    """
+
+    def forward(self, x):
+        if not (self.training and dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1):
+            return super(SyncBatchNorm2d, self).forward(x)
+        xf = x.float()
+        count = xf.new_full((1, ), xf.numel() // xf.shape[1])
+        stats = AllReduceSum.apply(torch.cat([xf.sum((0, 2, 3)), (xf * xf).sum((0, 2, 3)), count]))
+        c = xf.shape[1]
+        n = stats[-1]
+        mean = stats[:c] / n
+        var = (stats[c:2 * c] / n - mean * mean).clamp(min=0)
+        with torch.no_grad():
+            self.num_batches_tracked += 1
+            momentum = 1 / self.num_batches_tracked.item() if self.momentum is None else self.momentum
+            self.running_mean.mul_(1 - momentum).add_(mean.detach(), alpha=momentum)
+            self.running_var.mul_(1 - momentum).add_(var.detach() * n / (n - 1).clamp(min=1), alpha=momentum)
+        out = (xf - mean.view(1, -1, 1, 1)) * torch.rsqrt(var + self.eps).view(1, -1, 1, 1)
+        if self.affine:
+            out = out * self.weight.view(1, -1, 1, 1) + self.bias.view(1, -1, 1, 1)
+        return out.to(x.dtype)
+
+
+def convert_sync_batchnorm(model, modes=('ann', 'snn')):
+    """Swap the ann and/or snn BatchNorm of every ASBatchNorm2d for SyncBatchNorm2d, keeping its state."""
+    for m in model.modules():
+        if not isinstance(m, ASBatchNorm2d):
+            continue
+        for mode in modes:
+            bn = getattr(m, 'bn_' + mode)
+            sync_bn = SyncBatchNorm2d(bn.num_features, bn.eps, bn.momentum, bn.affine, bn.track_running_stats)
+            sync_bn.load_state_dict(bn.state_dict())
+            setattr(m, 'bn_' + mode, sync_bn.to(bn.weight.device))
+    return model
+
+
 class ASAct(nn.Module):
     def __init__(self):
         super(ASAct, self).__init__()
         self.use_ann =True
+        self.joint_split = 0
         self.act_ann = nn.ReLU(True)
         self.act_snn = LIFSpike()
 
     def forward(self, x):
+        if self.joint_split:
+            # split views cannot be modified in place
+            return joint_apply(x, self.joint_split, F.relu, self.act_snn)
         if self.use_ann:
             return self.act_ann(x)
         else:
@@ -179,6 +415,14 @@ class Multi_ResNet(nn.Module):
         super(Multi_ResNet, self).__init__()
         self.inplanes = 64
         self.T = 2
+        # run the T snn timesteps as one [B*T, ...] batch, only LIF neurons loop over time
+        self.multi_step = False
+        self.fused_lif = False
+        self.detach_reset = False
+        # joint forward as one [B*(T+1), ...] batch: ann samples first, then the T snn timesteps of every sample.
+        # Only taken once truncate_rank factorized some convs
+        self.fused_joint = False
+        self.forward_steps = 0
         self.conv1 = ASConv2d(3, self.inplanes, kernel_size=3, stride=1, padding=1, bias=False)
         self.bn1 = ASBatchNorm2d(self.inplanes)
         self.relu = ASAct()
@@ -210,12 +454,55 @@ class Multi_ResNet(nn.Module):
             if isinstance(m, (ASConv2d, ASLinear)):
                 print('Initialize layer: {}'.format(name))
                 m.initialize()
+        self.use_ann = True
+        self.build_registry()
+
+    def build_registry(self):
+        # collected once so that mode switches and state resets do not walk the module tree,
+        # call again after swapping submodules
+        self.as_modules = [m for m in self.modules() if isinstance(m, (ASConv2d, ASLinear, ASBatchNorm2d, ASAct))]
+        self.as_convs = [m for m in self.as_modules if isinstance(m, ASConv2d)]
+        self.lif_neurons = [m for m in self.modules() if isinstance(m, LIFSpike)]
+
+    def truncate_rank(self, ranks=None, energy=None):
+        """Truncate the factorization of every ASConv2d, see ASConv2d.truncate.
+        ranks maps module name prefixes to ranks (the longest matching prefix wins, '' matches every conv),
+        energy applies to the convs no prefix matches. Returns the kept rank per conv name.
+        """
+        ranks = ranks or {}
+        kept = {}
+        for name, m in self.named_modules():
+            if not isinstance(m, ASConv2d):
+                continue
+            prefixes = [p for p in ranks if name.startswith(p)]
+            if prefixes:
+                kept[name] = m.truncate(rank=ranks[max(prefixes, key=len)])
+            elif energy is not None:
+                kept[name] = m.truncate(energy=energy)
+            else:
+                kept[name] = m.rank
+        return kept
 
     def use_ann_mode_tag(self, tag=True):
         self.use_ann = tag
-        for m in self.modules():
-            if isinstance(m, (ASConv2d, ASLinear, ASBatchNorm2d, ASAct)):
-                m.use_ann = tag
+        for m in self.as_modules:
+            m.use_ann = tag
+            m.joint_split = 0
+
+    def joint_mode_tag(self, n):
+        # the first n samples of every batch take the ann path, use_ann_mode_tag ends the joint mode
+        self.use_ann = None
+        for m in self.as_modules:
+            m.joint_split = n
+
+    def reset_neurons(self, multi_step=None):
+        step_mode = 'm' if (self.multi_step if multi_step is None else multi_step) else 's'
+        for m in self.lif_neurons:
+            m.mem = 0
+            m.step_mode = step_mode
+            m.T = self.T
+            m.fused = self.fused_lif
+            m.detach_reset = self.detach_reset
 
     def _make_layer(self, block, planes, layers, stride=1):
         """A block with 'layers' layers
@@ -273,27 +560,186 @@ class Multi_ResNet(nn.Module):
 
         return x, middle_output1, middle_output2, middle_output3, final_fea, middle1_fea, middle2_fea, middle3_fea
 
-    def forward(self, x, snn_only=False):
-        for m in self.modules():
-            if isinstance(m, LIFSpike):
-                m.mem = 0
+    def stage_forward(self, i, x):
+        # backbone up to the i-th exit (0-2: middle heads, 3: final head)
+        if i == 0:
+            x = self.relu(self.bn1(self.conv1(x)))
+            return self.layer1(x)
+        return (self.layer2, self.layer3, self.layer4)[i - 1](x)
+
+    def exit_forward(self, i, x):
+        if i < 3:
+            x = (self.bottleneck1_1, self.bottleneck2_1, self.bottleneck3_1)[i](x)
+        x = torch.flatten(self.avgpool(x), 1)
+        return (self.middle_fc1, self.middle_fc2, self.middle_fc3, self.fc)[i](x)
+
+    @torch.no_grad()
+    def early_exit_forward(self, x, threshold=0.9, snn_only=True):
+        """Per-sample early exit at the first head whose softmax margin (top1 - top2) reaches threshold.
+        Args:
+            threshold (float or list): margin for the three middle heads, the final head always exits
+            snn_only (bool): accumulate the snn logits over T, otherwise run the ann
+        Returns:
+            logits of the exit head and the exit index (0-3) of every sample
+        """
+        thresholds = threshold if isinstance(threshold, (list, tuple)) else [threshold] * 3
+        self.reset_neurons()
+        self.use_ann_mode_tag(not snn_only)
+        # the snn runs time-batched so that exited samples can be dropped between stages
+        T = self.T if snn_only else 1
+        for m in self.lif_neurons:
+            m.step_mode = 'm'
+            m.T = T
+        B = x.shape[0]
+        h = x.unsqueeze(1).repeat(1, T, 1, 1, 1).flatten(0, 1)
+        logits = x.new_zeros(B, self.fc.out_features)
+        exits = torch.full((B, ), 3, dtype=torch.long, device=x.device)
+        active = torch.arange(B, device=x.device)
+        for i in range(4):
+            h = self.stage_forward(i, h)
+            out = self.exit_forward(i, h)
+            out = out.view(-1, T, out.shape[-1]).sum(1)
+            if i == 3:
+                logits[active] = out
+                break
+            top2 = torch.softmax(out, dim=1).topk(2, dim=1).values
+            done = (top2[:, 0] - top2[:, 1]) >= thresholds[i]
+            logits[active[done]] = out[done]
+            exits[active[done]] = i
+            keep = ~done
+            active = active[keep]
+            if active.numel() == 0:
+                break
+            h = h.view(-1, T, *h.shape[1:])[keep].flatten(0, 1)
+        return logits, exits
+
+    @torch.no_grad()
+    def adaptive_forward(self, x, threshold=0.9, patience=0, min_steps=1):
+        """Anytime snn inference with per-sample termination.
+        After every timestep a sample stops once the softmax margin of its accumulated final logits
+        reaches threshold, or (patience > 0) its prediction has not changed for patience timesteps.
+        Stopped samples are dropped from the batch together with their membrane state.
+        Returns:
+            logits accumulated up to the stop of every sample and the timesteps it used
+        """
+        self.reset_neurons()
+        self.use_ann_mode_tag(False)
+        for m in self.lif_neurons:
+            m.step_mode = 's'
+        B = x.shape[0]
+        logits = x.new_zeros(B, self.fc.out_features)
+        steps = torch.full((B, ), self.T, dtype=torch.long, device=x.device)
+        active = torch.arange(B, device=x.device)
+        stable = torch.zeros(B, dtype=torch.long, device=x.device)
+        acc = 0
+        pred = None
+        for t in range(self.T):
+            # the middle heads do not affect the final logits and are skipped
+            h = x
+            for i in range(4):
+                h = self.stage_forward(i, h)
+            acc = acc + self.exit_forward(3, h)
+            if t == self.T - 1:
+                logits[active] = acc
+                break
+            new_pred = acc.argmax(1)
+            if pred is not None:
+                stable = torch.where(new_pred == pred, stable + 1, torch.zeros_like(stable))
+            pred = new_pred
+            top2 = torch.softmax(acc, dim=1).topk(2, dim=1).values
+            done = (top2[:, 0] - top2[:, 1]) >= threshold
+            if patience > 0:
+                done |= stable >= patience
+            if t + 1 < min_steps or not done.any():
+                continue
+            logits[active[done]] = acc[done]
+            steps[active[done]] = t + 1
+            keep = ~done
+            if not keep.any():
+                break
+            active, acc, pred, stable, x = active[keep], acc[keep], pred[keep], stable[keep], x[keep]
+            for m in self.lif_neurons:
+                if isinstance(m.mem, torch.Tensor):
+                    m.mem = m.mem[keep]
+        return logits, steps
+
+    @torch.no_grad()
+    def exit_macs(self, input_size=(3, 32, 32)):
+        """MACs of one ann pass (= one snn timestep) per sample, as (backbone stage, exit head) for each exit."""
+        macs = [0]
+
+        def hook(m, input, output):
+            macs[0] += output.numel() * m.in_features if isinstance(m, ASLinear) else m.macs(output)
+
+        handles = [m.register_forward_hook(hook) for m in self.as_modules if isinstance(m, (ASConv2d, ASLinear))]
+        training = self.training
+        self.eval()
+        self.reset_neurons()
+        self.use_ann_mode_tag(True)
+        h = next(self.parameters()).new_zeros(1, *input_size)
+        costs = []
+        for i in range(4):
+            macs[0] = 0
+            h = self.stage_forward(i, h)
+            stage = macs[0]
+            macs[0] = 0
+            self.exit_forward(i, h)
+            costs.append((stage, macs[0]))
+        for handle in handles:
+            handle.remove()
+        self.train(training)
+        return costs
+
+    def snn_forward(self, x):
+        if self.multi_step:
+            B = x.shape[0]
+            x_seq = x.unsqueeze(1).repeat(1, self.T, 1, 1, 1).flatten(0, 1)
+            outputs = self.one_time_forward(x_seq)
+            return [out.view(B, self.T, *out.shape[1:]).sum(1) for out in outputs]
+        all_outputs = []
+        for i in range(self.T):
+            outputs = self.one_time_forward(x)
+            all_outputs += [outputs]
+        return [sum([outputs[i] for outputs in all_outputs]) for i in range(8)]
+
+    def fused_joint_forward(self, x):
+        """The ann pass and the multi-step snn pass in one batch, every AS layer applies its ann and snn
+        parameters to its slice. Factorized convs share the V conv over the whole batch."""
+        B = x.shape[0]
+        self.reset_neurons(multi_step=True)
+        x_seq = x.unsqueeze(1).repeat(1, self.T, 1, 1, 1).flatten(0, 1)
+        self.joint_mode_tag(B)
+        outputs = self.one_time_forward(torch.cat([x, x_seq]))
+        self.use_ann_mode_tag(True)
+        outputs = [out.split([B, B * self.T]) for out in outputs]
+        ann_outputs = [ann for ann, _ in outputs]
+        snn_outputs = [snn.view(B, self.T, *snn.shape[1:]).sum(1) for _, snn in outputs]
+        return ann_outputs, snn_outputs
 
+    def forward(self, x, snn_only=False):
+        self.reset_neurons()
+        self.forward_steps += 1
+        for m in self.as_convs:
+            m.forward_step = self.forward_steps
+        try:
+            return self._forward(x, snn_only)
+        finally:
+            for m in self.as_convs:
+                m.forward_step = None
+
+    def _forward(self, x, snn_only):
         if snn_only:
             self.use_ann_mode_tag(tag=False)
-            all_outputs = []
-            for i in range(self.T):
-                outputs = self.one_time_forward(x)
-                all_outputs += [outputs]
-            return [sum([outputs[i] for outputs in all_outputs]) for i in range(8)]
+            return self.snn_forward(x)
+        elif self.fused_joint and any(m.factorized for m in self.as_convs):
+            # only factorized convs share work (the V conv) between the slices, a full rank joint batch just adds
+            # the split and cat copies of every layer
+            return self.fused_joint_forward(x)
         else:
             self.use_ann_mode_tag(True)
             ann_outputs = self.one_time_forward(x)
             self.use_ann_mode_tag(tag=False)
-            all_outputs = []
-            for i in range(self.T):
-                outputs = self.one_time_forward(x)
-                all_outputs += [outputs]
-            snn_outputs = [sum([outputs[i] for outputs in all_outputs]) for i in range(8)]
+            snn_outputs = self.snn_forward(x)
             return ann_outputs, snn_outputs
 
 
@@ -0,0 +1,141 @@
+import json
+import weakref
+
+import torch
+
+from models.resnet import ASConv2d, ASLinear, ASAct
+from models.spike_storage import is_spike
+
+
+class SpikeMonitor(object):
+    """Opt-in spike rate and synaptic operation counter for a Multi_ResNet.
+    Hooks are only registered inside the with block, outside it the model runs untouched.
+    Counts are accumulated as device tensors and only read back by report().
+
+    Layers fed with spikes do one accumulate (AC) per nonzero input and synapse, i.e. MACs x input firing rate;
+    layers fed with real values (the first conv, the heads after average pooling) do full MACs.
+    Energies default to 45nm estimates of 0.9pJ per AC and 4.6pJ per MAC.
+
+    Example:
+        >>> with SpikeMonitor(model) as monitor:
+        >>>     test(model, test_loader, device)
+        >>> monitor.save('spikes.json')
+    """
+
+    def __init__(self, model, e_ac=0.9e-12, e_mac=4.6e-12):
+        self.model = model
+        self.e_ac = e_ac
+        self.e_mac = e_mac
+        self.handles = []
+        self.names = {m: name for name, m in model.named_modules()}
+        self.samples = {'ann': 0, 'snn': 0}
+        self.steps = {}
+        # LIFSpike -> [spikes per timestep tensor, elements per timestep list]
+        self.spikes = {}
+        # ASAct -> [nonzero ann activations tensor, elements]
+        self.density = {}
+        # ASConv2d / ASLinear -> {'ac': tensor, 'mac': int, 'ann_mac': int}
+        self.ops = {}
+        # id -> ASAct output of a fused joint batch, whose snn slice holds spikes but carries no spike tag
+        self.joint_spikes = weakref.WeakValueDictionary()
+
+    def __enter__(self):
+        self.handles.append(self.model.register_forward_pre_hook(self._start))
+        for m in self.model.lif_neurons:
+            self.handles.append(m.register_forward_hook(self._lif_hook))
+        for m in self.model.as_modules:
+            if isinstance(m, ASAct):
+                self.handles.append(m.register_forward_hook(self._act_hook))
+            elif isinstance(m, (ASConv2d, ASLinear)):
+                self.handles.append(m.register_forward_hook(self._synapse_hook))
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _start(self, model, inputs):
+        # timestep counters restart with every forward, as the membranes do
+        self.steps = {}
+
+    def _lif_hook(self, m, inputs, spikes):
+        T = self.model.T
+        if m not in self.spikes:
+            self.spikes[m] = [spikes.new_zeros(T, dtype=torch.float64), [0] * T]
+        counts, numel = self.spikes[m]
+        if m.step_mode == 'm':
+            counts += spikes.detach().view(-1, m.T, spikes[0].numel()).sum((0, 2), dtype=torch.float64)
+            for t in range(m.T):
+                numel[t] += spikes.numel() // m.T
+        else:
+            t = self.steps.get(m, 0) % T
+            self.steps[m] = t + 1
+            counts[t] += spikes.detach().sum(dtype=torch.float64)
+            numel[t] += spikes.numel()
+
+    def _act_hook(self, m, inputs, output):
+        if m.joint_split:
+            # fused joint batch: the first joint_split samples are ann activations, the rest snn spikes
+            self.joint_spikes[id(output)] = output
+            output = output[:m.joint_split]
+        elif not m.use_ann:
+            return
+        if m not in self.density:
+            self.density[m] = [output.new_zeros((), dtype=torch.float64), 0]
+        self.density[m][0] += output.detach().count_nonzero()
+        self.density[m][1] += output.numel()
+
+    def _synapse_hook(self, m, inputs, output):
+        x = inputs[0]
+        n = m.joint_split
+        if not n:
+            self._count_synapse(m, m.use_ann, x, output, is_spike(x))
+            return
+        spikes = self.joint_spikes.get(id(x)) is x
+        self._count_synapse(m, True, x[:n], output[:n], False)
+        self._count_synapse(m, False, x[n:], output[n:], spikes)
+
+    def _count_synapse(self, m, use_ann, x, output, spikes):
+        macs = output.numel() * m.in_features if isinstance(m, ASLinear) else m.macs(output)
+        if m not in self.ops:
+            self.ops[m] = {'ac': x.new_zeros((), dtype=torch.float64), 'mac': 0, 'ann_mac': 0}
+        ops = self.ops[m]
+        if m is self.model.conv1:
+            # every pass starts at conv1, an snn sample passes it T times
+            self.samples['ann' if use_ann else 'snn'] += x.shape[0]
+        if use_ann:
+            ops['ann_mac'] += macs
+        elif spikes:
+            ops['ac'] += x.detach().count_nonzero() * (macs / x.numel())
+        else:
+            ops['mac'] += macs
+
+    def report(self):
+        """Per-layer rates and operation counts per sample, and the estimated snn vs ann energy per sample."""
+        n = max(self.samples['snn'] / self.model.T, 1)
+        n_ann = max(self.samples['ann'], 1)
+        layers = []
+        for m, (counts, numel) in self.spikes.items():
+            counts = counts.tolist()
+            rates = [c / e if e else 0. for c, e in zip(counts, numel)]
+            layers.append({'name': self.names[m], 'rate_per_timestep': rates,
+                           'rate': sum(counts) / max(sum(numel), 1)})
+        activations = [{'name': self.names[m], 'density': nonzero.item() / max(numel, 1)}
+                       for m, (nonzero, numel) in self.density.items()]
+        synapses = []
+        for m, ops in self.ops.items():
+            synapses.append({'name': self.names[m], 'sops': ops['ac'].item() / n, 'macs': ops['mac'] / n,
+                             'ann_macs': ops['ann_mac'] / n_ann})
+        sops = sum(s['sops'] for s in synapses)
+        macs = sum(s['macs'] for s in synapses)
+        ann_macs = sum(s['ann_macs'] for s in synapses)
+        return {'samples': {'ann': self.samples['ann'], 'snn': self.samples['snn'] // self.model.T},
+                'T': self.model.T, 'e_ac': self.e_ac, 'e_mac': self.e_mac,
+                'neurons': layers, 'ann_activations': activations, 'synapses': synapses,
+                'total': {'sops': sops, 'macs': macs, 'snn_energy_j': sops * self.e_ac + macs * self.e_mac,
+                          'ann_macs': ann_macs, 'ann_energy_j': ann_macs * self.e_mac}}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
@@ -0,0 +1,61 @@
+import torch
+import torch.nn.functional as F
+
+
+def mark_spike(x):
+    """Tag a binary spike tensor so that packed_spike_storage() packs it when autograd saves it.
+    Under autocast the spike is returned in the autocast dtype (0/1 are exact), otherwise the next conv would save
+    its own untagged cast of it.
+    """
+    device_type = x.device.type
+    if torch.is_autocast_enabled(device_type):
+        x = x.to(torch.get_autocast_dtype(device_type))
+    x._is_spike = True
+    return x
+
+
+def is_spike(x):
+    return getattr(x, '_is_spike', False)
+
+
+def pack_spikes(x):
+    # 1 bit per element, eight consecutive elements per byte
+    bits = (x.detach().reshape(-1) != 0).to(torch.uint8)
+    bits = F.pad(bits, [0, (8 - bits.numel() % 8) % 8]).view(-1, 8)
+    shifts = torch.arange(8, dtype=torch.uint8, device=x.device)
+    return (bits << shifts).sum(1, dtype=torch.uint8)
+
+
+def unpack_spikes(packed, shape, dtype):
+    shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(1) >> shifts) & 1
+    numel = 1
+    for s in shape:
+        numel *= s
+    return bits.view(-1)[:numel].to(dtype).view(shape)
+
+
+class packed_spike_storage(torch.autograd.graph.saved_tensors_hooks):
+    """Save marked spike tensors for backward as 1-bit packed uint8 (32x smaller than float32).
+
+    Example:
+        >>> with packed_spike_storage():
+        >>>     loss = compute_loss(model, images, labels)
+        >>> loss.backward()
+    """
+
+    def __init__(self):
+        super(packed_spike_storage, self).__init__(self.pack, self.unpack)
+
+    @staticmethod
+    def pack(x):
+        if is_spike(x) and x.is_floating_point():
+            return pack_spikes(x), x.shape, x.dtype
+        return x
+
+    @staticmethod
+    def unpack(saved):
+        if isinstance(saved, tuple):
+            packed, shape, dtype = saved
+            return unpack_spikes(packed, shape, dtype)
+        return saved